@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'data.apps.DataConfig',
     'rest_framework',
     'oauth2_provider',
@@ -51,6 +52,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'data.middleware.MetricsMiddleware',
+    'data.middleware.ServerTimingMiddleware',
+    'data.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -92,15 +96,59 @@ WSGI_APPLICATION = 'brickandmortr_server.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'data.backends.postgresql_pooled',
         'NAME': 'brickandmortr_server',
         'USER': 'admin',
         'PASSWORD': settings_secret.db_password,
         'HOST': 'localhost',
         'PORT': '5432',
-    }
+        # Connections go back to the worker's pool at the end of each request rather than being closed, see
+        # data.backends.postgresql_pooled
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'MAX_SIZE': 10,
+            'TIMEOUT': 5,
+            'HEALTH_CHECK_INTERVAL': 30,
+            'MAX_LIFETIME': 3600,
+        },
+    },
+    # A replica is another entry here, e.g. a second local instance streaming from this one:
+    # 'replica': {
+    #     'ENGINE': 'data.backends.postgresql_pooled',
+    #     'NAME': 'brickandmortr_server',
+    #     'USER': 'admin',
+    #     'PASSWORD': settings_secret.db_password,
+    #     'HOST': 'localhost',
+    #     'PORT': '5433',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+# Catalog reads are spread over these DATABASES aliases in proportion to their weights, e.g. {'replica': 1}. With
+# none, or when every replica is unreachable (retried after DATABASE_REPLICA_RETRY_SECONDS), they use the primary.
+# A signed in user's reads stay on the primary for DATABASE_REPLICA_PIN_SECONDS after a request of theirs writes.
+# The pins are kept in the DATABASE_REPLICA_PIN_CACHE cache, which every worker has to share.
+DATABASE_ROUTERS = ['data.routers.ReplicaRouter']
+DATABASE_REPLICAS = {}
+DATABASE_REPLICA_PIN_SECONDS = 15
+DATABASE_REPLICA_RETRY_SECONDS = 30
+DATABASE_REPLICA_PIN_CACHE = 'shared'
+
+# 'shared' holds state every worker has to see, like the replica pins. It is a table in the primary database by
+# default (create it with manage.py createcachetable), and can be pointed at memcached or Redis instead.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'data_shared_cache',
+    },
+}
+
+# Addresses allowed to scrape the Prometheus metrics at /data/metrics
+INTERNAL_IPS = ['127.0.0.1']
+
 
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
@@ -132,7 +180,7 @@ AUTH_USER_MODEL = 'data.BrickAndMortrUser'
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         # 'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
-        'rest_framework_api_key.permissions.HasAPIAccess',
+        'data.auth.CachedHasAPIAccess',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'oauth2_provider.ext.rest_framework.OAuth2Authentication',
@@ -142,6 +190,32 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+OAUTH2_PROVIDER = {
+    'OAUTH2_VALIDATOR_CLASS': 'data.auth.CachedOAuth2Validator',
+}
+
+# Valid API keys and access tokens each worker remembers, and for how many seconds. A revoked key or token is
+# forgotten at once by the worker that revoked it and within AUTH_CACHE_TTL seconds by the others.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 60
+
+# Catalog search -- "python" scores every row with fuzzywuzzy, "index" scores a shortlist from an in-process n-gram
+# index (rebuilt every CATALOG_SEARCH_INDEX_TTL seconds to pick up other workers' writes), "trigram" uses the pg_trgm
+# GIN indexes created by data migration 0020 (only available when the pg_trgm extension could be installed)
+CATALOG_SEARCH_BACKEND = 'python'
+CATALOG_SEARCH_INDEX_TTL = 300
+CATALOG_SEARCH_TRIGRAM_THRESHOLD = 0.3
+# Worker processes the python and index backends spread large batches of fuzzy scoring over, 0 to score in-process.
+# Each web worker starts them from gunicorn_conf's post_fork hook, before it opens any database connections.
+CATALOG_FUZZY_PROCESSES = 0
+
+# Seconds clients and CDNs may reuse a catalog response before revalidating it with its ETag
+CATALOG_CACHE_MAX_AGE = 60
+
+# Share of requests ServerTimingMiddleware times, on top of requests that send the request header
+SERVER_TIMING_SAMPLE_RATE = 0.01
+SERVER_TIMING_REQUEST_HEADER = 'X-Server-Timing'
+
 AUTHENTICATION_BACKENDS = (
     'oauth2_provider.backends.OAuth2Backend',
     'rest_framework_social_oauth2.backends.DjangoOAuth2',
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import copy
+
+from django.conf import settings
+from oauth2_provider.models import AccessToken
+from oauth2_provider.oauth2_validators import OAuth2Validator
+from rest_framework_api_key.models import APIKey
+from rest_framework_api_key.permissions import HasAPIAccess
+
+from data import metrics
+from data.caching import TTLCache
+
+# Per worker, so a revocation reaches other workers within AUTH_CACHE_TTL seconds; the signals in data.signals
+# invalidate the worker that made it immediately
+api_keys = TTLCache(getattr(settings, 'AUTH_CACHE_SIZE', 10000), getattr(settings, 'AUTH_CACHE_TTL', 60))
+access_tokens = TTLCache(getattr(settings, 'AUTH_CACHE_SIZE', 10000), getattr(settings, 'AUTH_CACHE_TTL', 60))
+
+
+class CachedHasAPIAccess(HasAPIAccess):
+    """
+    HasAPIAccess remembering valid keys, so only the first request with a key looks it up
+    """
+
+    def has_permission(self, request, view):
+        api_key = request.META.get('HTTP_API_KEY', '')
+        if api_keys.get(api_key):
+            metrics.AUTH_CACHE.labels('api_key', 'hit').inc()
+            return True
+        metrics.AUTH_CACHE.labels('api_key', 'miss').inc()
+        # Unknown keys aren't remembered, so a key works as soon as it is created
+        if not APIKey.objects.filter(key=api_key).exists():
+            return False
+        api_keys.set(api_key, True)
+        return True
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """
+    OAuth2Validator remembering access tokens with their application and user. Expiry and scopes are still checked
+    on every request. Both
+    OAuth2Authentication and OAuth2TokenMiddleware validate the bearer token, so a miss is shared by the two.
+    """
+
+    def validate_bearer_token(self, token, scopes, request):
+        if not token:
+            return False
+        access_token = access_tokens.get(token)
+        if access_token is None:
+            metrics.AUTH_CACHE.labels('access_token', 'miss').inc()
+            try:
+                access_token = AccessToken.objects.select_related("application", "user").get(token=token)
+            except AccessToken.DoesNotExist:
+                return False
+            access_tokens.set(token, access_token)
+        else:
+            metrics.AUTH_CACHE.labels('access_token', 'hit').inc()
+        if not access_token.is_valid(scopes):
+            return False
+        # Requests get their own copies, so nothing a view does to its user leaks into the next request
+        access_token = copy.copy(access_token)
+        access_token.user = copy.copy(access_token.user)
+        request.client = access_token.application
+        request.user = access_token.user
+        request.scopes = scopes
+        request.access_token = access_token
+        return True
+
+
+def forget_access_token(token):
+    access_tokens.pop(token)
+
+
+def forget_user(user_id):
+    access_tokens.discard_where(lambda access_token: access_token.user_id == user_id)
+
+
+def forget_api_key(key):
+    api_keys.pop(key)
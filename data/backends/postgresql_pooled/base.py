@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base
+
+from data.backends.postgresql_pooled.creation import DatabaseCreation
+from data.backends.postgresql_pooled.pool import get_pool
+from data.backends.postgresql_pooled.utils import TimedCursorDebugWrapper, TimedCursorWrapper
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The PostgreSQL backend with connections checked out of a per-process ConnectionPool instead of opened for every
+    request. Closing the connection at the end of a request (CONN_MAX_AGE = 0) returns it to the pool.
+
+    The pool is configured by the database's POOL settings, e.g.
+
+        'POOL': {'MAX_SIZE': 10, 'TIMEOUT': 5, 'HEALTH_CHECK_INTERVAL': 30, 'MAX_LIFETIME': 3600}
+
+    Cursors also count their queries and SQL time towards data.timing.capture_timings.
+    """
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        # The pool the open connection was checked out of
+        self.checked_out_of = None
+        # Whether that connection was opened for this checkout rather than reused from the pool
+        self.fresh_connection = False
+
+    def get_new_connection(self, conn_params):
+        # Connections Django opens to the maintenance database are never closed, so they aren't pooled
+        self.fresh_connection = True
+        if self.alias == NO_DB_ALIAS:
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+        options = {name.lower(): value for name, value in self.settings_dict.get('POOL', {}).items()}
+        pool = get_pool((self.alias, tuple(sorted(conn_params.items()))), self.alias, **options)
+        self.fresh_connection = False
+
+        def connect():
+            self.fresh_connection = True
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+
+        connection = pool.checkout(connect)
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        self.checked_out_of = pool
+        return connection
+
+    def init_connection_state(self):
+        super(DatabaseWrapper, self).init_connection_state()
+        # Session settings outlive the checkout, so they only need setting once per physical connection
+        if self.fresh_connection:
+            self.set_trigram_threshold()
+
+    def set_trigram_threshold(self):
+        # Imported here since the app's modules can't be imported while the backend is loading
+        from data import search
+        if search.search_backend() == search.TRIGRAM:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SET pg_trgm.similarity_threshold = %s", [search.trigram_threshold()])
+
+    def make_cursor(self, cursor):
+        return TimedCursorWrapper(cursor, self)
+
+    def make_debug_cursor(self, cursor):
+        return TimedCursorDebugWrapper(cursor, self)
+
+    def _close(self):
+        pool, self.checked_out_of = self.checked_out_of, None
+        if pool is None or self.connection is None:
+            return super(DatabaseWrapper, self)._close()
+        with self.wrap_database_errors:
+            pool.release(self.connection)
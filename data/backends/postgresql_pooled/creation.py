@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.backends.postgresql import creation
+
+from data.backends.postgresql_pooled.pool import close_pools
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections, including other aliases' such as test mirrors, would keep the database in use
+        close_pools(test_database_name)
+        super(DatabaseCreation, self)._destroy_test_db(test_database_name, verbosity)
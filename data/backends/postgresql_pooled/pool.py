@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from data import metrics
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+DEFAULT_MAX_LIFETIME = 3600.0
+
+
+class ConnectionPool(object):
+    """
+    Idle psycopg2 connections of one worker process, reused across requests instead of paying the connect and auth
+    handshake each time. At most max_size connections are open at once; a checkout beyond that waits up to timeout
+    seconds for one to be released.
+
+    A connection is checked before it is handed out again: closed ones are dropped, ones idle for longer than
+    health_check_interval seconds must answer SELECT 1, and ones older than max_lifetime seconds are replaced.
+    """
+
+    def __init__(self, alias, max_size=DEFAULT_MAX_SIZE, timeout=DEFAULT_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, max_lifetime=DEFAULT_MAX_LIFETIME):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_lifetime = max_lifetime
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        # Connections inherited from a parent process share its sockets and must not be used
+        self.pid = os.getpid()
+        self.idle = []
+        self.opened_at = {}
+        self.in_use = 0
+
+    @property
+    def size(self):
+        return len(self.idle) + self.in_use
+
+    def checkout(self, connect):
+        """
+        A healthy idle connection, or a new one from connect() when the pool has room
+        """
+        started = time.time()
+        with self.condition:
+            if self.pid != os.getpid():
+                self.reset()
+            while True:
+                while self.idle:
+                    connection, released_at = self.idle.pop()
+                    if self.healthy(connection, released_at):
+                        self.lend(started, "reused")
+                        return connection
+                    self.discard(connection)
+                if self.size < self.max_size:
+                    break
+                remaining = started + self.timeout - time.time()
+                if remaining <= 0:
+                    metrics.DB_POOL_CHECKOUTS.labels(self.alias, "timeout").inc()
+                    raise psycopg2.OperationalError(
+                        "No database connection was released within %.1f seconds, all %d of the %s pool are in use"
+                        % (self.timeout, self.max_size, self.alias))
+                self.condition.wait(remaining)
+            # Reserve the slot before connecting so other threads can't overshoot max_size meanwhile
+            self.in_use += 1
+        try:
+            connection = connect()
+        except Exception:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.opened_at[id(connection)] = time.time()
+            self.in_use -= 1
+            self.lend(started, "opened")
+        return connection
+
+    def lend(self, started, outcome):
+        self.in_use += 1
+        metrics.DB_POOL_WAIT.labels(self.alias).observe(time.time() - started)
+        metrics.DB_POOL_CHECKOUTS.labels(self.alias, outcome).inc()
+        metrics.DB_POOL_IN_USE.labels(self.alias).set(self.in_use)
+
+    def healthy(self, connection, released_at):
+        if connection.closed:
+            return False
+        now = time.time()
+        if now - self.opened_at.get(id(connection), now) > self.max_lifetime:
+            return False
+        if now - released_at < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except psycopg2.Error:
+            return False
+        return True
+
+    def discard(self, connection):
+        self.opened_at.pop(id(connection), None)
+        metrics.DB_POOL_DISCARDS.labels(self.alias).inc()
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def release(self, connection):
+        """
+        Return a checked out connection, rolling back whatever transaction it was left in
+        """
+        reusable = not connection.closed and os.getpid() == self.pid
+        if reusable and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                reusable = False
+            else:
+                reusable = connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+        with self.condition:
+            if os.getpid() != self.pid:
+                return
+            self.in_use -= 1
+            if reusable:
+                self.idle.append((connection, time.time()))
+            else:
+                self.discard(connection)
+            metrics.DB_POOL_IN_USE.labels(self.alias).set(self.in_use)
+            self.condition.notify()
+
+    def close(self):
+        """
+        Close every idle connection, e.g. before dropping the database they are connected to
+        """
+        with self.condition:
+            while self.idle:
+                connection, _ = self.idle.pop()
+                self.opened_at.pop(id(connection), None)
+                connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, alias, **options):
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(alias, **options)
+        return _pools[key]
+
+
+def close_pools(database):
+    """
+    Close the idle connections of every pool connected to the database
+    """
+    with _pools_lock:
+        pools = [pool for (_, params), pool in _pools.items() if dict(params).get('database') == database]
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+from data.timing import record_query
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """
+    Adds every query's duration to the Timings being captured on the thread, see data.timing.capture_timings. With
+    nothing captured a query pays for two clock reads and a thread-local lookup.
+    """
+
+    def execute(self, sql, params=None):
+        started = time.time()
+        try:
+            return super(TimedCursorWrapper, self).execute(sql, params)
+        finally:
+            record_query(time.time() - started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+        try:
+            return super(TimedCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            record_query(time.time() - started)
+
+
+class TimedCursorDebugWrapper(TimedCursorWrapper, CursorDebugWrapper):
+    pass
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+from calendar import timegm
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from data.models import CatalogVersion
+from data.routers import internal_writes
+
+
+def bump_versions(*models):
+    """
+    Mark the tables of models as changed, invalidating the ETags of every response built from them
+    """
+    now = timezone.now()
+    with internal_writes():
+        for model in models:
+            table = model._meta.db_table
+            if not CatalogVersion.objects.filter(table=table).update(version=F('version') + 1, modified_on=now):
+                CatalogVersion.objects.get_or_create(table=table, defaults={'version': 1, 'modified_on': now})
+
+
+def table_version(model):
+    """
+    Current catalog version and modification time of model's table, None if it has never changed. The time tells
+    apart versions that were reused after a rolled back transaction.
+    """
+    return CatalogVersion.objects.filter(table=model._meta.db_table).values_list('version', 'modified_on').first()
+
+
+def catalog_validators(models):
+    """
+    ETag and Last-Modified timestamp for a response built from the tables of models, read in one query
+    """
+    tables = [model._meta.db_table for model in models]
+    versions = {version.table: version for version in CatalogVersion.objects.filter(table__in=tables)}
+    state = ";".join("%s:%d" % (table, versions[table].version if table in versions else 0) for table in tables)
+    etag = '"%s"' % hashlib.md5(state.encode('utf-8')).hexdigest()
+    last_modified = None
+    if versions:
+        last_modified = timegm(max(version.modified_on for version in versions.values()).utctimetuple())
+    return etag, last_modified
+
+
+def catalog_condition(*models):
+    """
+    View decorator answering conditional GETs from the catalog versions of models, so a 304 skips the view
+    entirely. Successful responses carry the validators and a public Cache-Control so CDNs can reuse them.
+
+    Applied beneath DRF's dispatch (e.g. with method_decorator on get) so API key checks still run first.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            etag, last_modified = catalog_validators(models)
+            # For views keyed on the catalog state, like the home feed
+            request.catalog_etag = etag
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = func(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                # Views serving an older state, like a stale home feed, label it with its own ETag
+                if not response.has_header('ETag'):
+                    response['ETag'] = etag
+                    if last_modified:
+                        response['Last-Modified'] = http_date(last_modified)
+                patch_cache_control(response, public=True, max_age=getattr(settings, 'CATALOG_CACHE_MAX_AGE', 60))
+                patch_vary_headers(response, ('Api-Key',))
+            return response
+        return inner
+    return decorator
+
+
+class TTLCache(object):
+    """
+    Thread-safe in-process mapping whose entries expire after ttl seconds, evicting the least recently used entry
+    beyond maxsize
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return default
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -2,3 +2,4 @@ new_items = "new_items"
 sale = "sale"
 price_high = "price_high"
 price_low = "price_low"
+relevance = "relevance"
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.db import connections, router
+from django.db.models import Case, When, Value, IntegerField, Q
+
+from data.filters import item_filters, combine
+from data.models import Item
+
+# Facet name -> column it groups by. Each facet is counted with its own query_params filter left out.
+FACET_COLUMNS = OrderedDict([
+    ("categories", "category"),
+    ("designers", "designer_id"),
+    ("stores", "store_id"),
+    ("subcategories", "subcategory_id"),
+])
+
+FACETS_SQL = """
+SELECT f.category, f.designer_id, f.store_id, f.subcategory_id, s.size,
+       GROUPING(f.category), GROUPING(f.designer_id), GROUPING(f.store_id), GROUPING(f.subcategory_id),
+       GROUPING(s.size),
+       COUNT(*) FILTER (WHERE s.n = 1 AND f.in_categories = 1),
+       COUNT(*) FILTER (WHERE s.n = 1 AND f.in_designers = 1),
+       COUNT(*) FILTER (WHERE s.n = 1 AND f.in_stores = 1),
+       COUNT(*) FILTER (WHERE s.n = 1 AND f.in_subcategories = 1),
+       COUNT(DISTINCT f.id) FILTER (WHERE f.in_sizes = 1),
+       MIN(f.price) FILTER (WHERE s.n = 1 AND f.in_price = 1),
+       MAX(f.price) FILTER (WHERE s.n = 1 AND f.in_price = 1)
+FROM ({items}) f
+CROSS JOIN LATERAL unnest(CASE WHEN cardinality(f.sizes) > 0 THEN f.sizes ELSE ARRAY[NULL]::varchar[] END)
+    WITH ORDINALITY AS s(size, n)
+WHERE f.in_categories = 1 OR f.in_designers = 1 OR f.in_stores = 1 OR f.in_subcategories = 1 OR f.in_sizes = 1
+    OR f.in_price = 1
+GROUP BY GROUPING SETS ((f.category), (f.designer_id), (f.store_id), (f.subcategory_id), (s.size), ())
+"""
+
+
+def _flag(q):
+    # 1 when a row passes q, computed per row so every facet's filter can be evaluated in the same scan
+    if not q.children:
+        return Value(1, output_field=IntegerField())
+    return Case(When(q, then=Value(1)), default=Value(0), output_field=IntegerField())
+
+
+def facet_filters(params):
+    """
+    The combined filter each facet is counted under, i.e. every query_params filter except the facet's own.
+    Sizes keep the subcategory ids that were picked, dropping only the sizes picked within them.
+    """
+    filters = item_filters(params)
+    flags = OrderedDict((name, combine(filters, exclude=(name,))) for name in FACET_COLUMNS)
+    sizes_q = combine(filters, exclude=("subcategories",))
+    if "subcategories" in filters:
+        sizes_q &= Q(subcategory_id__in=[subcategory["id"] for subcategory in params["subcategories"]])
+    flags["sizes"] = sizes_q
+    flags["price"] = combine(filters, exclude=("price",))
+    return flags
+
+
+def item_facets(params):
+    """
+    Counts per category, designer, store, subcategory and size plus the price range for an ItemList query_params
+    dict, computed in one GROUPING SETS query over the items
+    """
+    flags = OrderedDict(("in_" + name, _flag(q)) for name, q in facet_filters(params).items())
+    items = Item.objects.annotate(**flags).values('id', 'category', 'designer', 'store', 'subcategory', 'sizes',
+                                                  'price', *flags.keys())
+    # Routed like the other catalog reads, so replicas take the facet counts too
+    alias = router.db_for_read(Item)
+    items_sql, items_params = items.query.get_compiler(alias).as_sql()
+    with connections[alias].cursor() as cursor:
+        cursor.execute(FACETS_SQL.format(items=items_sql), items_params)
+        rows = cursor.fetchall()
+
+    facets = OrderedDict((name, []) for name in list(FACET_COLUMNS) + ["sizes"])
+    facets["price"] = {"min": None, "max": None}
+    for row in rows:
+        keys, groupings, counts, (price_min, price_max) = row[:5], row[5:10], row[10:15], row[15:]
+        if all(groupings):
+            facets["price"] = {
+                "min": None if price_min is None else unicode(price_min),
+                "max": None if price_max is None else unicode(price_max),
+            }
+            continue
+        position = groupings.index(0)
+        name = list(facets)[position]
+        if keys[position] is not None and counts[position]:
+            facets[name].append({"value": keys[position], "count": counts[position]})
+    for name in facets:
+        if name != "price":
+            facets[name].sort(key=lambda facet: facet["value"])
+    return facets
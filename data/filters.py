@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db.models import Q
+
+from data import constants
+from data.models import Item
+from data.search import search_q, rank
+
+SORT_ORDERINGS = {
+    constants.new_items: ('-added_on', 'name'),
+    constants.sale: ('-sale', 'name'),
+    constants.price_low: ('price', 'name'),
+    constants.price_high: ('-price', 'name'),
+}
+DEFAULT_ORDERING = ('name',)
+
+
+def parse_query_params(param_string):
+    return json.loads(param_string) if param_string else {}
+
+
+def subcategories_q(subcategories):
+    q = Q(pk__in=[])
+    for subcategory in subcategories:
+        if "sizes" in subcategory:
+            q |= Q(subcategory_id=subcategory["id"], sizes__overlap=subcategory["sizes"])
+        else:
+            q |= Q(subcategory_id=subcategory["id"], sizes__len__gt=0)
+    return q
+
+
+def price_q(price_info):
+    q = Q()
+    if "max" in price_info:
+        q &= Q(price__lte=Decimal(unicode(price_info["max"])))
+    if "min" in price_info:
+        q &= Q(price__gte=Decimal(unicode(price_info["min"])))
+    return q
+
+
+def item_filters(params):
+    """
+    Compile the filters of an ItemList query_params dict into Q objects, keyed by the parameter they came from
+    """
+    filters = OrderedDict()
+    if params.get("search", ""):
+        filters["search"] = search_q(Item, 'name', params["search"])
+    if params.get("categories", []):
+        filters["categories"] = Q(category__in=params["categories"])
+    if params.get("designers", []):
+        filters["designers"] = Q(designer__in=params["designers"])
+    if params.get("stores", []):
+        filters["stores"] = Q(store__in=params["stores"])
+    if params.get("subcategories", []):
+        filters["subcategories"] = subcategories_q(params["subcategories"])
+    if "max" in params.get("price", {}) or "min" in params.get("price", {}):
+        filters["price"] = price_q(params["price"])
+    return filters
+
+
+def combine(filters, exclude=()):
+    q = Q()
+    for key, value in filters.items():
+        if key not in exclude:
+            q &= value
+    return q
+
+
+def filter_items(params, queryset=None):
+    """
+    Build a single queryset for an ItemList query_params dict, so filtering and sorting run in one SQL statement
+    """
+    if queryset is None:
+        queryset = Item.objects.all()
+    ordering = SORT_ORDERINGS.get(params.get("sort", ""), DEFAULT_ORDERING)
+    queryset = queryset.filter(combine(item_filters(params))).order_by(*ordering)
+    if params.get("sort", "") == constants.relevance and params.get("search", ""):
+        queryset = rank(queryset, 'name', params["search"])
+    return queryset
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import itertools
+import math
+import threading
+
+import numpy
+from django.db.models import F, FloatField, Func
+
+from data.caching import table_version
+from data.models import Store
+from data.util import batch_distance, EARTH_RADIUS_MILES
+
+MILES_PER_DEGREE = math.radians(1) * EARTH_RADIUS_MILES
+HALF_CIRCUMFERENCE_MILES = math.pi * EARTH_RADIUS_MILES
+GRID_CELL_DEGREES = 0.25
+MAX_NEAREST_STORES = 100
+
+# Great circle distance in miles from a point, the SQL form of data.util.distance
+DISTANCE_SQL = """
+2 * %s * ASIN(LEAST(1.0, SQRT(
+    POWER(SIN(RADIANS({lat} - %s) / 2), 2) +
+    COS(RADIANS(%s)) * COS(RADIANS({lat})) * POWER(SIN(RADIANS({lon} - %s) / 2), 2)
+)))
+"""
+
+
+def bounding_box(lat, lon, radius):
+    """
+    (min_lat, max_lat, min_lon, max_lon) of a box holding every point within radius miles of lat, lon. The
+    longitude bounds are None when the box reaches a pole or crosses the antimeridian.
+    """
+    angle = math.degrees(float(radius) / EARTH_RADIUS_MILES)
+    min_lat, max_lat = lat - angle, lat + angle
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), None, None
+    # The widest longitude span is at the latitude where the circle touches the meridians, not at lat itself
+    lon_angle = math.degrees(math.asin(min(1.0, math.sin(math.radians(angle)) / math.cos(math.radians(lat)))))
+    min_lon, max_lon = lon - lon_angle, lon + lon_angle
+    if min_lon < -180 or max_lon > 180:
+        return min_lat, max_lat, None, None
+    return min_lat, max_lat, min_lon, max_lon
+
+
+class Distance(Func):
+    """
+    Distance in miles from lat, lon to each row's lat and lon columns
+    """
+
+    def __init__(self, lat, lon, **extra):
+        super(Distance, self).__init__(F('lat'), F('lon'), output_field=FloatField(), **extra)
+        self.lat, self.lon = lat, lon
+
+    def as_sql(self, compiler, connection):
+        lat_sql, lat_params = compiler.compile(self.source_expressions[0])
+        lon_sql, lon_params = compiler.compile(self.source_expressions[1])
+        params = [EARTH_RADIUS_MILES] + lat_params + [self.lat, self.lat] + lat_params + lon_params + [self.lon]
+        return DISTANCE_SQL.format(lat=lat_sql, lon=lon_sql), params
+
+
+def by_distance(queryset, lat, lon):
+    """
+    Rows of queryset nearest first, annotated with their distance in miles from lat, lon
+    """
+    return queryset.annotate(distance=Distance(float(lat), float(lon))).order_by('distance', 'name')
+
+
+def within_radius(queryset, lat, lon, radius):
+    """
+    Rows of queryset within radius miles of lat, lon, nearest first, annotated with their distance.
+
+    The bounding box narrows the rows with the (lat, lon) index before the exact distance is computed.
+    """
+    lat, lon, radius = float(lat), float(lon), float(radius)
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius)
+    queryset = queryset.filter(lat__gte=min_lat, lat__lte=max_lat)
+    if min_lon is not None:
+        queryset = queryset.filter(lon__gte=min_lon, lon__lte=max_lon)
+    return by_distance(queryset, lat, lon).filter(distance__lte=radius)
+
+
+class StoreGrid(object):
+    """
+    In-memory grid of store locations in GRID_CELL_DEGREES cells, for nearest store queries.
+
+    Store ids and coordinates are cached as arrays sorted by cell, with each cell a slice of them. A query searches
+    the cells around a point within a radius that doubles until it holds k stores, so its cost depends on how many
+    stores are nearby rather than on the total. The grid is rebuilt whenever the Store catalog version changes,
+    which picks up writes made by other workers on the next query.
+    """
+
+    def __init__(self, cell_degrees=GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.lats = numpy.empty(0)
+        self.lons = numpy.empty(0)
+        self.cells = {}
+        self.version = None
+        self.built = False
+        self.lock = threading.RLock()
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def build(self, version):
+        stores = list(Store.objects.values_list('id', 'lat', 'lon'))
+        ids = numpy.array([pk for pk, _, _ in stores], dtype=numpy.int64)
+        lats = numpy.array([lat for _, lat, _ in stores], dtype=numpy.float64)
+        lons = numpy.array([lon for _, _, lon in stores], dtype=numpy.float64)
+        cell_lats = numpy.floor(lats / self.cell_degrees).astype(numpy.int64)
+        cell_lons = numpy.floor(lons / self.cell_degrees).astype(numpy.int64)
+        order = numpy.lexsort((ids, cell_lons, cell_lats))
+        ids, lats, lons, cell_lats, cell_lons = ids[order], lats[order], lons[order], cell_lats[order], cell_lons[order]
+
+        cells = {}
+        starts = numpy.flatnonzero(numpy.diff(cell_lats) | numpy.diff(cell_lons)) + 1
+        for start, end in zip(numpy.r_[0, starts], numpy.r_[starts, len(ids)]):
+            if start < end:
+                cells[(int(cell_lats[start]), int(cell_lons[start]))] = (int(start), int(end))
+        with self.lock:
+            self.ids, self.lats, self.lons, self.cells = ids, lats, lons, cells
+            self.version = version
+            self.built = True
+
+    def ensure_current(self):
+        version = table_version(Store)
+        if not self.built or version != self.version:
+            self.build(version)
+
+    def positions_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Array positions of the stores in the cells covering a bounding box
+        """
+        (low_lat, low_lon), (high_lat, high_lon) = self.cell(min_lat, min_lon or 0), self.cell(max_lat, max_lon or 0)
+        if min_lon is None or (high_lat - low_lat + 1) * (high_lon - low_lon + 1) > len(self.cells):
+            # Scanning the occupied cells is cheaper than probing every cell of a box this large
+            keys = [key for key in self.cells if low_lat <= key[0] <= high_lat and
+                    (min_lon is None or low_lon <= key[1] <= high_lon)]
+        else:
+            keys = itertools.product(range(low_lat, high_lat + 1), range(low_lon, high_lon + 1))
+        ranges = [numpy.arange(*self.cells[key]) for key in keys if key in self.cells]
+        return numpy.concatenate(ranges) if ranges else numpy.empty(0, dtype=numpy.int64)
+
+    def nearest(self, lat, lon, k):
+        """
+        Ids of the k stores closest to lat, lon, nearest first
+        """
+        self.ensure_current()
+        with self.lock:
+            k = min(k, len(self.ids))
+            radius = self.cell_degrees * MILES_PER_DEGREE
+            while k > 0:
+                positions = self.positions_in_box(*bounding_box(lat, lon, radius))
+                ids = self.ids[positions]
+                miles = batch_distance(lon, lat, self.lons[positions], self.lats[positions])
+                closest = numpy.lexsort((ids, miles))[:k]
+                # Every store outside the box is farther than radius, so k stores within it are the k nearest
+                if numpy.count_nonzero(miles[closest] <= radius) == k or radius >= HALF_CIRCUMFERENCE_MILES:
+                    return [int(pk) for pk in ids[closest]]
+                radius *= 2
+            return []
+
+
+_store_grid = StoreGrid()
+
+
+def nearest_store_ids(lat, lon, k):
+    return _store_grid.nearest(float(lat), float(lon), min(int(k), MAX_NEAREST_STORES))
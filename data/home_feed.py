@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from data import constants
+from data.caching import catalog_validators
+from data.filters import filter_items
+from data.models import CLOTHING_CATEGORIES, FeedSnapshot, Item, Store, Designer, SubCategory
+from data.routers import internal_writes
+from data.serializers import ITEM_RELATED, ItemReadSerializer
+
+FEED_NAME = 'home'
+# The tables whose changes make the feed stale
+FEED_MODELS = (Item, Store, Designer, SubCategory)
+SECTION_SIZE = 10
+
+# (etag, payload) of the snapshot this worker served last
+_served = None
+
+
+def sections():
+    """
+    The queries behind the home screen: featured items, new items, items on sale and the top of each category
+    """
+    items = Item.objects.select_related(*ITEM_RELATED)
+    featured = list(items.filter(featured=True).order_by('id')[:SECTION_SIZE])
+    if not featured:
+        featured = list(items.order_by('-price', 'name')[:SECTION_SIZE])
+    feed = OrderedDict([
+        ("featured", featured),
+        ("new_items", filter_items({"sort": constants.new_items}).select_related(*ITEM_RELATED)[:SECTION_SIZE]),
+        ("sale", filter_items({"sort": constants.sale}).select_related(*ITEM_RELATED)[:SECTION_SIZE]),
+    ])
+    feed["categories"] = OrderedDict(
+        (category, filter_items({"categories": [category]}).select_related(*ITEM_RELATED)[:SECTION_SIZE])
+        for category, _ in CLOTHING_CATEGORIES)
+    return feed
+
+
+def render_feed():
+    # One serializer for every section, so the stores and designers they share are represented once
+    serializer = ItemReadSerializer()
+    feed = sections()
+    data = OrderedDict((name, [serializer.to_representation(item) for item in feed[name]])
+                       for name in ("featured", "new_items", "sale"))
+    data["categories"] = OrderedDict((category, [serializer.to_representation(item) for item in items])
+                                     for category, items in feed["categories"].items())
+    data["built_on"] = timezone.now().isoformat()
+    return JSONRenderer().render(data).decode('utf-8')
+
+
+def refresh(etag=None):
+    """
+    Rebuild the stored home feed snapshot, returning it
+    """
+    etag = etag or catalog_validators(FEED_MODELS)[0]
+    values = {"etag": etag, "payload": render_feed(), "built_on": timezone.now()}
+    with internal_writes():
+        try:
+            with transaction.atomic():
+                snapshot, _ = FeedSnapshot.objects.update_or_create(name=FEED_NAME, defaults=values)
+        except IntegrityError:
+            # Another worker stored the first snapshot at the same time
+            snapshot, _ = FeedSnapshot.objects.update_or_create(name=FEED_NAME, defaults=values)
+    return snapshot
+
+
+def current_snapshot(etag):
+    """
+    (etag, payload) of the home feed to serve for the catalog state etag, or None before a snapshot is stored.
+    Served from this worker's copy when it matches, else from the stored snapshot even when that is older than
+    etag: refresh_home_feed rebuilds it, a request never does, so requests never write.
+    """
+    global _served
+    served = _served
+    if served is not None and served[0] == etag:
+        return served
+    snapshot = FeedSnapshot.objects.filter(name=FEED_NAME).values_list('etag', 'payload').first()
+    if snapshot is None:
+        return served
+    _served = snapshot
+    return snapshot
+
+
+def expire():
+    """
+    Forget this worker's copy of the feed, for writes that bypass the catalog versions
+    """
+    global _served
+    _served = None
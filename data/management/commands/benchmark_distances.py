@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import timeit
+
+import numpy
+from django.core.management.base import BaseCommand
+
+from data.util import haversine, batch_haversine
+
+
+class Command(BaseCommand):
+    help = "Times per-store haversine calls against one batch_haversine pass over random store coordinates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--radius', type=float, default=25.0)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        user_lat, user_lon, radius = 30.27, -97.74, options['radius']
+        for size in options['sizes']:
+            lats = [random.uniform(25.0, 49.0) for _ in range(size)]
+            lons = [random.uniform(-124.0, -67.0) for _ in range(size)]
+            lat_array, lon_array = numpy.array(lats), numpy.array(lons)
+
+            def scalar():
+                return [haversine(user_lon, user_lat, lon, lat, radius) for lat, lon in zip(lats, lons)]
+
+            def batch():
+                return batch_haversine(user_lon, user_lat, lon_array, lat_array, radius)[1]
+
+            if list(batch()) != scalar():
+                self.stderr.write("batch_haversine disagrees with haversine at %d stores" % size)
+            scalar_time = min(timeit.repeat(scalar, number=1, repeat=options['repeat']))
+            batch_time = min(timeit.repeat(batch, number=1, repeat=options['repeat']))
+            self.stdout.write("%7d stores: haversine %8.2f ms, batch_haversine %6.2f ms, %5.0fx faster" % (
+                size, scalar_time * 1000, batch_time * 1000, scalar_time / batch_time))
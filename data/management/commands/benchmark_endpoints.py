@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils.six import StringIO
+from rest_framework.test import APIClient
+from rest_framework_api_key.models import APIKey
+
+from data import constants
+from data.filters import SORT_ORDERINGS
+from data.models import BrickAndMortrUser, Item, Store, Designer, SubCategory
+from data.timing import capture_timings, percentile
+
+# Query counts don't depend on the machine, so the budget for each scenario is committed with the code
+QUERY_BUDGETS = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'benchmarks',
+                                              'query_counts.json'))
+
+# Stores and designers generated alongside each catalog size
+STORES_PER_ITEM = 0.005
+DESIGNERS_PER_ITEM = 0.002
+
+# Latency regressions smaller than this many milliseconds are treated as noise
+NOISE_MS = 5.0
+
+# Statuses of a successful read or write
+SUCCESS_STATUSES = (200, 201, 204)
+
+
+def item_scenarios(store, designer, subcategory):
+    """
+    ItemList query_params for every sort combined with each filter, alone and all together
+    """
+    filters = OrderedDict([
+        ("none", {}),
+        ("search", {"search": "slim jeans"}),
+        ("categories", {"categories": ["c", "s"]}),
+        ("designers", {"designers": [designer.id]}),
+        ("stores", {"stores": [store.id]}),
+        ("subcategories", {"subcategories": [{"id": subcategory.id}]}),
+        ("sizes", {"subcategories": [{"id": subcategory.id, "sizes": ["small", "large"]}]}),
+        ("price", {"price": {"min": "20.00", "max": "120.00"}}),
+    ])
+    combined = {}
+    for params in filters.values():
+        combined.update(params)
+    filters["all"] = combined
+    sorts = ["default"] + sorted(SORT_ORDERINGS) + [constants.relevance]
+    for sort in sorts:
+        for name, params in filters.items():
+            params = dict(params, sort=sort) if sort != "default" else params
+            path = '/data/items/?query_params=' + json.dumps(params)
+            yield "items sort=%s filter=%s" % (sort, name), 'get', path, None
+
+
+def scenarios():
+    store = Store.objects.order_by('id').first()
+    designer = Designer.objects.order_by('id').first()
+    item = Item.objects.order_by('id').first()
+    subcategory = SubCategory.objects.filter(parent_category="c").order_by('id').first()
+    near = "lat=%s&lon=%s" % (store.lat, store.lon)
+    paths = [
+        ("designers", '/data/designers/'),
+        ("designers name", '/data/designers/?name=designer%201'),
+        ("designers category", '/data/designers/?category=w'),
+        ("designers radius", '/data/designers/?%s&radius=10' % near),
+        ("designer detail", '/data/designers/%d/' % designer.id),
+        ("designer items", '/data/designers/%d/items/' % designer.id),
+        ("designer items cursor", '/data/designers/%d/items/?cursor=' % designer.id),
+        ("items cursor", '/data/items/?cursor='),
+        ("item detail", '/data/items/%d/' % item.id),
+        ("items featured", '/data/items/featured'),
+        ("items facets", '/data/items/facets'),
+        ("items facets filtered", '/data/items/facets?query_params=' + json.dumps(
+            {"categories": ["c"], "price": {"min": "20.00", "max": "120.00"}})),
+        ("stores", '/data/stores/'),
+        ("stores name", '/data/stores/?name=store%201'),
+        ("stores radius", '/data/stores/?%s&radius=10' % near),
+        ("stores nearest", '/data/stores/?%s&k=20' % near),
+        ("store detail", '/data/stores/%d/' % store.id),
+        ("store items", '/data/stores/%d/items/' % store.id),
+        ("home", '/data/home'),
+        ("subcategories", '/data/subcategories/'),
+    ]
+    # The user's bag and favorites are read after the writes have filled them
+    user_paths = [
+        ("user bag", '/data/users/bag'),
+        ("user bag hydrated", '/data/users/bag?hydrate=1'),
+        ("user favorites", '/data/users/favorites'),
+        ("user favorites hydrated", '/data/users/favorites?hydrate=1'),
+        ("user preferences", '/data/users/preferences'),
+    ]
+    return ([(name, 'get', path, None) for name, path in paths] + list(item_scenarios(store, designer, subcategory)) +
+            user_write_scenarios(item) + [(name, 'get', path, None) for name, path in user_paths])
+
+
+def new_user():
+    return {"name": "Benchmark", "username": "benchmark-%s@test.com" % uuid.uuid4().hex, "password": "benchmark"}
+
+
+def user_write_scenarios(item):
+    """
+    Writes that only touch users, each leaving the same state when repeated. Data may be a function giving each
+    run's request body.
+    """
+    return [
+        ("create user", 'post', '/data/create_user', new_user),
+        ("user bag replace", 'post', '/data/users/bag', [item.id, {"id": item.id, "quantity": 2}]),
+        ("user bag add", 'patch', '/data/users/bag', {"op": "add", "value": item.id + 1}),
+        ("user bag remove", 'patch', '/data/users/bag', {"op": "remove", "value": item.id + 1}),
+        ("user favorites replace", 'post', '/data/users/favorites', [item.id]),
+        ("user favorites add", 'patch', '/data/users/favorites', {"op": "add", "value": item.id + 1}),
+        ("user favorites remove", 'patch', '/data/users/favorites', {"op": "remove", "value": item.id + 1}),
+        ("user preferences replace", 'post', '/data/users/preferences', {"size": "small"}),
+        ("user preferences set", 'patch', '/data/users/preferences', {"op": "set", "key": "category", "value": "c"}),
+        ("user preferences remove", 'patch', '/data/users/preferences', {"op": "remove", "key": "category"}),
+    ]
+
+
+def catalog_write_scenarios():
+    """
+    The generate_* views, which add designers, stores and items on every run
+    """
+    return [
+        ("generate designers", 'get', '/data/generate_designers/', None),
+        ("generate stores", 'get', '/data/generate_stores/', None),
+        ("generate items", 'get', '/data/generate_items/?category=c', None),
+    ]
+
+
+class Command(BaseCommand):
+    help = ("Loads synthetic catalogs into a test database, times every /data/ endpoint against them and fails "
+            "when a query count goes past the committed budget, or latencies regress past a local baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--query-budgets', default=QUERY_BUDGETS)
+        parser.add_argument('--update-query-budgets', action='store_true',
+                            help="Store this run's query counts as the budgets instead of comparing against them")
+        parser.add_argument('--baseline',
+                            help="Local file of latencies from an earlier run on this machine to compare against")
+        parser.add_argument('--update-baseline', action='store_true',
+                            help="Store this run's latencies as the baseline instead of comparing against it")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="Allowed relative increase of p50/p95 wall time, serialization time and SQL time")
+        parser.add_argument('--output', help="Also write this run's results to a JSON file")
+        parser.add_argument('--keepdb', action='store_true',
+                            help="Keep the benchmark database and its catalog between runs")
+
+    def handle(self, *args, **options):
+        self.options = options
+        if options['update_baseline'] and not options['baseline']:
+            raise CommandError("--update-baseline needs a --baseline file to store the latencies in")
+        old_name = connection.settings_dict['NAME']
+        # The same environment the test runner sets up, so the test client's host is allowed
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb'])
+        try:
+            results = self.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['output']:
+            self.write_json(options['output'], results)
+
+        regressions = []
+        if options['update_query_budgets']:
+            self.write_json(options['query_budgets'], self.query_counts(results))
+            self.stdout.write("Stored query budgets in %s" % options['query_budgets'])
+        else:
+            with open(options['query_budgets']) as budgets_file:
+                regressions.extend(self.query_regressions(json.load(budgets_file), results))
+        if options['update_baseline']:
+            self.write_json(options['baseline'], results)
+            self.stdout.write("Stored baseline in %s" % options['baseline'])
+        elif options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                regressions.extend(self.latency_regressions(json.load(baseline_file), results))
+        if regressions:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write("No regressions")
+
+    def run(self):
+        client = APIClient()
+        key, _ = APIKey.objects.get_or_create(name="benchmark", key="benchmark")
+        client.credentials(HTTP_API_KEY=key.key)
+        user, _ = BrickAndMortrUser.objects.get_or_create(username="benchmark@test.com")
+        client.force_authenticate(user=user)
+
+        results = OrderedDict()
+        for size in sorted(self.options['sizes']):
+            self.load_catalog(size)
+            results[unicode(size)] = size_results = OrderedDict()
+            for name, method, path, data in scenarios():
+                size_results[name] = self.measure(client, method, path, data)
+                self.report(size, name, size_results[name])
+            # Rows the generate_* views add are deleted again, so each size is measured against its own catalog
+            latest = {model: model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+                      for model in (Item, Store, Designer)}
+            for name, method, path, data in catalog_write_scenarios():
+                size_results[name] = self.measure(client, method, path, data)
+                self.report(size, name, size_results[name])
+            for model in (Item, Store, Designer):
+                model.objects.filter(id__gt=latest[model]).delete()
+        return results
+
+    def load_catalog(self, size):
+        # Sizes are loaded smallest first, each topping up the catalog left by the previous one
+        missing = size - Item.objects.count()
+        if missing > 0:
+            self.stdout.write("Loading a %d item catalog" % size)
+            call_command('generate_catalog', items=missing, seed=self.options['seed'] + size, stdout=StringIO(),
+                         stores=max(int(missing * STORES_PER_ITEM), 1),
+                         designers=max(int(missing * DESIGNERS_PER_ITEM), 1))
+        # Requests only serve the home feed, they don't build it
+        call_command('refresh_home_feed', stdout=StringIO())
+
+    def measure(self, client, method, path, data=None):
+        samples = []
+        for run in range(self.options['warmup'] + self.options['repeat']):
+            body = data() if callable(data) else data
+            with capture_timings() as timings:
+                if body is None:
+                    response = getattr(client, method)(path)
+                else:
+                    response = getattr(client, method)(path, body, format='json')
+            if response.status_code not in SUCCESS_STATUSES:
+                raise CommandError("%s %s returned %d" % (method.upper(), path, response.status_code))
+            if run >= self.options['warmup']:
+                samples.append(timings)
+        serialize_ms = [sample.sections.get('serialize', 0.0) for sample in samples]
+        # The fewest queries, since a sample can pay for reloading an expired cache entry, e.g. the API key
+        return OrderedDict([
+            ("method", method.upper()),
+            ("path", path),
+            ("queries", min(sample.queries for sample in samples)),
+            ("sql_ms", percentile([sample.sql_ms for sample in samples], 50)),
+            ("app_ms", percentile([sample.app_ms for sample in samples], 50)),
+            ("serialize_p50_ms", percentile(serialize_ms, 50)),
+            ("serialize_p95_ms", percentile(serialize_ms, 95)),
+            ("serialize_p99_ms", percentile(serialize_ms, 99)),
+            ("p50_ms", percentile([sample.wall_ms for sample in samples], 50)),
+            ("p95_ms", percentile([sample.wall_ms for sample in samples], 95)),
+            ("p99_ms", percentile([sample.wall_ms for sample in samples], 99)),
+        ])
+
+    def report(self, size, name, result):
+        self.stdout.write(
+            "%8d  %-48s %3d queries  sql %8.1f ms  app %8.1f ms  serialize p50 %7.1f p95 %7.1f p99 %7.1f  "
+            "p50 %8.1f  p95 %8.1f  p99 %8.1f" % (
+                size, name, result["queries"], result["sql_ms"], result["app_ms"], result["serialize_p50_ms"],
+                result["serialize_p95_ms"], result["serialize_p99_ms"], result["p50_ms"], result["p95_ms"],
+                result["p99_ms"]))
+
+    def query_counts(self, results):
+        """
+        The most queries each scenario ran at any catalog size
+        """
+        counts = OrderedDict()
+        for size_results in results.values():
+            for name, result in size_results.items():
+                counts[name] = max(counts.get(name, 0), result["queries"])
+        return counts
+
+    def query_regressions(self, budgets, results):
+        regressions = ["%s: no query budget, run with --update-query-budgets to store one" % name
+                       for name in self.query_counts(results) if name not in budgets]
+        for size, size_results in results.items():
+            for name, result in size_results.items():
+                if name in budgets and result["queries"] > budgets[name]:
+                    regressions.append("%s items, %s: %d queries, budget %d" % (
+                        size, name, result["queries"], budgets[name]))
+        return regressions
+
+    def latency_regressions(self, baseline, results):
+        regressions = []
+        for size, size_results in results.items():
+            for name, result in size_results.items():
+                expected = baseline.get(size, {}).get(name)
+                if expected is None:
+                    continue
+                for metric in ("sql_ms", "serialize_p50_ms", "serialize_p95_ms", "p50_ms", "p95_ms"):
+                    # Baselines stored before a metric was recorded don't budget it
+                    if metric not in expected:
+                        continue
+                    budget = expected[metric] * (1 + self.options['threshold']) + NOISE_MS
+                    if result[metric] > budget:
+                        regressions.append("%s items, %s: %s %.1f, budget %.1f" % (
+                            size, name, metric, result[metric], budget))
+        return regressions
+
+    def write_json(self, path, results):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2, separators=(',', ': '))
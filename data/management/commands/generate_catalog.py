@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import random
+import time
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from data.caching import bump_versions
+from data.models import Item, Store, Designer, SubCategory
+from data.search_index import expire_indexes
+from data.subcategories import rebuild_counts
+
+# Name, latitude and longitude of the metro areas stores are spread around
+METROS = [
+    ("Austin", 30.27, -97.74), ("Dallas", 32.78, -96.80), ("Houston", 29.76, -95.37), ("New York", 40.71, -74.01),
+    ("Los Angeles", 34.05, -118.24), ("Chicago", 41.88, -87.63), ("San Francisco", 37.77, -122.42),
+    ("Seattle", 47.61, -122.33), ("Miami", 25.76, -80.19), ("Atlanta", 33.75, -84.39), ("Denver", 39.74, -104.99),
+    ("Boston", 42.36, -71.06),
+]
+
+SUBCATEGORIES = {
+    "c": ["Denim Jackets", "Jeans", "Chinos", "T-Shirts", "Hoodies"],
+    "s": ["Sneakers", "Boots", "Loafers"],
+    "b": ["Totes", "Clutches", "Wallets"],
+    "a": ["Bracelets", "Necklaces", "Watches"],
+}
+
+SIZES = {
+    "c": ["xs", "small", "medium", "large", "x-large", "xx-large"],
+    "s": ["6", "7", "8", "9", "10", "11", "12", "13"],
+    "b": ["one size"],
+    "a": ["one size"],
+}
+
+# Share of items in each category
+CATEGORY_WEIGHTS = [("c", 0.55), ("s", 0.2), ("b", 0.15), ("a", 0.1)]
+
+ADJECTIVES = ["Classic", "Slim", "Relaxed", "Vintage", "Raw", "Washed", "Cropped", "Oversized", "Leather", "Suede",
+              "Canvas", "Wool", "Linen", "Organic", "Heritage", "Utility", "Tailored", "Distressed"]
+
+THUMBNAIL = "https://cdn.zeplin.io/5969021e44c5978909d5278b/assets/1CE5FF07-E70F-4413-85BF-49C08AA559DE.png"
+STORE_THUMBNAIL = "https://cdn.zeplin.io/5969021e44c5978909d5278b/assets/198CD09C-1814-4FD9-84E1-CC0156C6C742.png"
+DESIGNER_IMAGE = "https://cdn.zeplin.io/5969021e44c5978909d5278b/assets/3DD29AFB-028A-483D-8FE1-5678407C4189.png"
+
+# Item fields in the order items() yields their values, loaded with COPY
+ITEM_FIELDS = ['name', 'sku', 'upc', 'price', 'images', 'store', 'designer', 'category', 'subcategory',
+               'designer_name', 'thumbnail', 'sizes', 'sale', 'old_price', 'added_on', 'featured']
+
+
+def copy_text(value):
+    """
+    A value in PostgreSQL's COPY text format
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, list):
+        value = "{%s}" % ",".join('"%s"' % unicode(element).replace("\\", "\\\\").replace('"', '\\"')
+                                  for element in value)
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    else:
+        value = unicode(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class Command(BaseCommand):
+    help = "Bulk inserts a synthetic catalog of stores, designers and items for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000000)
+        parser.add_argument('--stores', type=int, default=5000)
+        parser.add_argument('--designers', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        started = time.time()
+
+        subcategories = self.subcategories()
+        stores = self.bulk_insert(Store, self.stores(options['stores']))
+        designers = self.bulk_insert(Designer, self.designers(options['designers']))
+        store_ids = [store.id for store in stores]
+        self.copy_items(self.items(options['items'], store_ids, designers, subcategories))
+
+        # Bulk inserts skip the model signals that keep these up to date
+        rebuild_counts()
+        bump_versions(Item, Store, Designer, SubCategory)
+        expire_indexes()
+        self.stdout.write("Generated %d items, %d stores and %d designers in %.1fs" % (
+            options['items'], len(stores), len(designers), time.time() - started))
+
+    def bulk_insert(self, model, rows):
+        created = []
+        for batch in self.batches(rows):
+            with transaction.atomic():
+                created.extend(model.objects.bulk_create(batch, batch_size=self.batch_size))
+            self.stdout.write("Inserted %d %s" % (len(created), model._meta.verbose_name_plural))
+        return created
+
+    def copy_items(self, rows):
+        # COPY skips building a model instance and compiling an INSERT for every item
+        columns = ", ".join('"%s"' % Item._meta.get_field(field).column for field in ITEM_FIELDS)
+        sql = 'COPY "%s" (%s) FROM STDIN' % (Item._meta.db_table, columns)
+        inserted = 0
+        for batch in self.batches(rows):
+            data = StringIO("".join("\t".join(copy_text(value) for value in row) + "\n" for row in batch))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.copy_expert(sql, data)
+            inserted += len(batch)
+            self.stdout.write("Inserted %d items" % inserted)
+
+    def batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def subcategories(self):
+        subcategories = {}
+        for category, names in SUBCATEGORIES.items():
+            for name in names:
+                subcategory, _ = SubCategory.objects.get_or_create(display_name=name, parent_category=category)
+                subcategories.setdefault(category, []).append(subcategory.id)
+        return subcategories
+
+    def stores(self, count):
+        offset = Store.objects.count()
+        for i in range(offset, offset + count):
+            metro, lat, lon = self.random.choice(METROS)
+            yield Store(lat=round(self.random.gauss(lat, 0.12), 6),
+                        lon=round(self.random.gauss(lon, 0.12), 6),
+                        name="Store " + unicode(i),
+                        address="%d Main St, %s" % (self.random.randint(1, 9999), metro),
+                        contact_email="email" + unicode(i) + "@test.com",
+                        contact_phone="%03d-555-%04d" % (self.random.randint(200, 999), i % 10000),
+                        thumbnail=STORE_THUMBNAIL,
+                        hours=[[10, 20]] * 6 + [[12, 18]])
+
+    def designers(self, count):
+        offset = Designer.objects.count()
+        for i in range(offset, offset + count):
+            yield Designer(name="Designer " + unicode(i), category="m" if i % 2 == 0 else "w", image=DESIGNER_IMAGE)
+
+    def price(self):
+        # Log-normal around $80, as fashion prices are skewed towards the low end with a long tail
+        return Decimal(min(max(self.random.lognormvariate(4.4, 0.8), 5.0), 5000.0)).quantize(Decimal('0.01'))
+
+    def items(self, count, store_ids, designers, subcategories):
+        categories, weights = zip(*CATEGORY_WEIGHTS)
+        now = timezone.now()
+        offset = Item.objects.count()
+        for i in range(offset, offset + count):
+            category = self.weighted_choice(categories, weights)
+            subcategory_id = self.random.choice(subcategories[category])
+            designer = self.random.choice(designers)
+            sizes = SIZES[category]
+            if len(sizes) > 1:
+                sizes = sorted(self.random.sample(sizes, self.random.randint(1, len(sizes))), key=sizes.index)
+            price = self.price()
+            sale = self.random.random() < 0.15
+            old_price = None
+            if sale:
+                old_price = (price / Decimal(1 - self.random.choice([0.1, 0.2, 0.3, 0.5]))).quantize(Decimal('0.01'))
+            subcategory_name = SUBCATEGORIES[category][subcategories[category].index(subcategory_id)]
+            yield ("%s %s %d" % (self.random.choice(ADJECTIVES), subcategory_name, i), unicode(i),
+                   unicode(i) + unicode(i), price, [THUMBNAIL + "?1=1", THUMBNAIL], self.random.choice(store_ids),
+                   designer.id, category, subcategory_id, designer.name, THUMBNAIL, sizes, sale, old_price,
+                   now - datetime.timedelta(seconds=self.random.randint(0, 365 * 24 * 3600)),
+                   self.random.random() < 0.001)
+
+    def weighted_choice(self, values, weights):
+        point = self.random.random() * sum(weights)
+        for value, weight in zip(values, weights):
+            point -= weight
+            if point < 0:
+                return value
+        return values[-1]
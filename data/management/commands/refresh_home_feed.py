@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from data import home_feed
+from data.caching import catalog_validators
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the stored home feed snapshot. With --interval, keeps running and rebuilds it whenever the "
+            "catalog changes, and at least every --max-age seconds")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help="Seconds between checks for catalog changes")
+        parser.add_argument('--max-age', type=float, default=3600,
+                            help="Rebuild after this many seconds even without catalog changes")
+
+    def handle(self, *args, **options):
+        snapshot = home_feed.refresh()
+        self.stdout.write("Built the home feed for catalog %s" % snapshot.etag)
+        built_at = time.time()
+        while options['interval']:
+            time.sleep(options['interval'])
+            close_old_connections()
+            etag = catalog_validators(home_feed.FEED_MODELS)[0]
+            if etag != snapshot.etag or time.time() - built_at >= options['max_age']:
+                snapshot = home_feed.refresh(etag)
+                built_at = time.time()
+                self.stdout.write("Built the home feed for catalog %s" % snapshot.etag)
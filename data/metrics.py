@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, \
+    generate_latest, multiprocess
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .15, .25, .35, .5, .75, 1.0, 1.5, 2.5, 5.0, 10.0, float('inf'))
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 7, 10, 15, 25, 50, 100, float('inf'))
+
+REQUESTS = Counter('brickandmortr_requests_total', "Requests by route, method and status",
+                   ['route', 'method', 'status'])
+ERRORS = Counter('brickandmortr_request_errors_total', "Requests that raised or returned a 5xx status",
+                 ['route', 'method'])
+LATENCY = Histogram('brickandmortr_request_duration_seconds', "Request wall clock time", ['route', 'method'],
+                    buckets=LATENCY_BUCKETS)
+SQL_TIME = Histogram('brickandmortr_request_sql_seconds', "Time spent in SQL per request", ['route', 'method'],
+                     buckets=LATENCY_BUCKETS)
+QUERIES = Histogram('brickandmortr_request_queries', "SQL queries per request", ['route', 'method'],
+                    buckets=QUERY_BUCKETS)
+
+DB_POOL_WAIT = Histogram('brickandmortr_db_pool_wait_seconds', "Time spent waiting to check out a database connection",
+                         ['alias'], buckets=LATENCY_BUCKETS)
+DB_POOL_CHECKOUTS = Counter('brickandmortr_db_pool_checkouts_total',
+                            "Database connection checkouts by outcome (reused, opened or timeout)",
+                            ['alias', 'outcome'])
+DB_POOL_DISCARDS = Counter('brickandmortr_db_pool_discards_total',
+                           "Pooled database connections closed as broken, too old or left mid-transaction", ['alias'])
+DB_POOL_IN_USE = Gauge('brickandmortr_db_pool_in_use', "Database connections checked out of the pool", ['alias'],
+                       multiprocess_mode='livesum')
+
+AUTH_CACHE = Counter('brickandmortr_auth_cache_total', "API key and access token cache lookups by result",
+                     ['cache', 'result'])
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+
+
+def route(request):
+    """
+    Low-cardinality label for the view a request resolved to
+    """
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else "unmatched"
+
+
+def observe(request, status, timings):
+    labels = (route(request), request.method)
+    REQUESTS.labels(labels[0], labels[1], unicode(status)).inc()
+    if status >= 500:
+        ERRORS.labels(*labels).inc()
+    LATENCY.labels(*labels).observe(timings.wall_ms / 1000.0)
+    SQL_TIME.labels(*labels).observe(timings.sql_ms / 1000.0)
+    QUERIES.labels(*labels).observe(timings.queries)
+
+
+def exposition():
+    """
+    The metrics in Prometheus text format. Under gunicorn every worker writes its samples to files in
+    PROMETHEUS_MULTIPROC_DIR, and they are summed here so a scrape of any worker covers all of them.
+    """
+    registry = REGISTRY
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
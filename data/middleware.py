@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from data import metrics, routers
+from data.timing import capture_timings
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware(object):
+    """
+    Reports where a request's time went, as a Server-Timing response header and a JSON log line: SQL query count
+    and time, view time, DRF serializer time and response render time.
+
+    Requests are timed when they carry the SERVER_TIMING_REQUEST_HEADER header, or at random at
+    SERVER_TIMING_SAMPLE_RATE. Untimed requests only pay for the sampling check.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def sampled(self, request):
+        header = getattr(settings, 'SERVER_TIMING_REQUEST_HEADER', 'X-Server-Timing')
+        if request.META.get('HTTP_' + header.upper().replace('-', '_')):
+            return True
+        return random.random() < getattr(settings, 'SERVER_TIMING_SAMPLE_RATE', 0.0)
+
+    def __call__(self, request):
+        if not self.sampled(request):
+            return self.get_response(request)
+        with capture_timings() as timings:
+            request.server_timings = timings
+            response = self.get_response(request)
+        self.report(request, response, timings)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'server_timings'):
+            request.server_timing_view_started = time.time()
+
+    def process_template_response(self, request, response):
+        # DRF responses render after the view returns, so the view ends here and rendering ends in the callback
+        started = getattr(request, 'server_timing_view_started', None)
+        if started is not None:
+            timings = request.server_timings
+            view_ended = time.time()
+            timings.add('view', (view_ended - started) * 1000)
+            request.server_timing_view_started = None
+            response.add_post_render_callback(
+                lambda rendered: timings.add('render', (time.time() - view_ended) * 1000))
+        return response
+
+    def report(self, request, response, timings):
+        started = getattr(request, 'server_timing_view_started', None)
+        if started is not None:
+            # Responses that are not rendered later, e.g. plain HttpResponses, end the view with the request
+            timings.add('view', (time.time() - started) * 1000)
+        metrics = [('db', timings.sql_ms, '%d queries' % timings.queries)]
+        metrics += [(name, ms, None) for name, ms in timings.sections.items()]
+        metrics.append(('total', timings.wall_ms, None))
+        response['Server-Timing'] = ", ".join(
+            '%s;dur=%.1f' % (name, ms) + (';desc="%s"' % description if description else "")
+            for name, ms, description in metrics)
+        record = {"method": request.method, "path": request.path, "status": response.status_code}
+        record.update(timings.as_dict())
+        logger.info("server_timing %s", json.dumps(record, sort_keys=True))
+
+
+class MetricsMiddleware(object):
+    """
+    Records every request's count, latency, SQL time and query count per route in the Prometheus metrics of
+    data.metrics, served at /data/metrics to INTERNAL_IPS
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = None
+        try:
+            with capture_timings() as timings:
+                response = self.get_response(request)
+        finally:
+            # Observed once the capture has ended, so requests whose view raised have their timings too
+            metrics.observe(request, response.status_code if response is not None else 500, timings)
+        return response
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Tracks each request for data.routers, so an authenticated user's reads stay on the primary for
+    DATABASE_REPLICA_PIN_SECONDS after a request of theirs writes, and replication lag can't hide their own changes
+    from them
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.start_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            routers.end_request()
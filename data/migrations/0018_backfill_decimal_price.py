@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+PRICE_PATTERN = r"'^\$?[0-9,]*\.?[0-9]+$'"
+
+
+def parse_price(column):
+    return ("CASE WHEN trim({column}) ~ {pattern} "
+            "THEN round(replace(ltrim(trim({column}), '$'), ',', '')::numeric, 2) END").format(column=column,
+                                                                                                 pattern=PRICE_PATTERN)
+
+
+# Refuse to migrate rather than store a made-up price for text that isn't one; an empty old_price means none
+CHECK_SQL = """
+DO $$
+DECLARE
+    unparseable text;
+BEGIN
+    SELECT string_agg(id::text, ', ' ORDER BY id) INTO unparseable FROM data_item
+    WHERE {price} IS NULL OR (coalesce(trim(old_price), '') <> '' AND {old_price} IS NULL);
+    IF unparseable IS NOT NULL THEN
+        RAISE EXCEPTION 'Items with unparseable price or old_price, fix them and migrate again: %', unparseable;
+    END IF;
+END
+$$;
+""".format(price=parse_price('price'), old_price=parse_price('old_price'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0017_item_decimal_price'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CHECK_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(
+            "UPDATE data_item SET price_decimal = {price}, old_price_decimal = {old_price};".format(
+                price=parse_price('price'), old_price=parse_price('old_price')),
+            "UPDATE data_item SET price = price_decimal::text, old_price = COALESCE(old_price_decimal::text, '');",
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0018_backfill_decimal_price'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='item',
+            name='price',
+        ),
+        migrations.RemoveField(
+            model_name='item',
+            name='old_price',
+        ),
+        migrations.RenameField(
+            model_name='item',
+            old_name='price_decimal',
+            new_name='price',
+        ),
+        migrations.RenameField(
+            model_name='item',
+            old_name='old_price_decimal',
+            new_name='old_price',
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='price',
+            field=models.DecimalField(db_index=True, decimal_places=2, max_digits=10),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction, DatabaseError
+
+TRIGRAM_INDEXES = (
+    ('data_item_name_trgm', 'data_item'),
+    ('data_designer_name_trgm', 'data_designer'),
+    ('data_store_name_trgm', 'data_store'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # pg_trgm is optional -- deployments that can't install extensions keep using the python search backend
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except DatabaseError:
+            return
+        for index_name, table in TRIGRAM_INDEXES:
+            cursor.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} USING gin (name gin_trgm_ops)".format(index_name,
+                                                                                                      table))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for index_name, table in TRIGRAM_INDEXES:
+            cursor.execute("DROP INDEX IF EXISTS {0}".format(index_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0019_replace_char_price'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
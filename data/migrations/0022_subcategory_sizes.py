@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0021_item_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubCategorySize',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.CharField(max_length=20)),
+                ('item_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='item_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subcategorysize',
+            name='subcategory',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sizes', to='data.SubCategory'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='subcategorysize',
+            unique_together=set([('subcategory', 'size')]),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE data_subcategory s SET item_count = counts.item_count
+            FROM (SELECT subcategory_id, COUNT(*) AS item_count FROM data_item WHERE subcategory_id IS NOT NULL
+                  GROUP BY subcategory_id) counts
+            WHERE s.id = counts.subcategory_id;
+            INSERT INTO data_subcategorysize (subcategory_id, size, item_count)
+            SELECT subcategory_id, size, COUNT(DISTINCT id) FROM data_item, unnest(sizes) AS size
+            WHERE subcategory_id IS NOT NULL GROUP BY subcategory_id, size;
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0023_catalog_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['lat', 'lon'], name='data_store_lat_04cf9f_idx'),
+        ),
+    ]
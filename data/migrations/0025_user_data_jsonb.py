@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0024_store_location_index'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='brickandmortruser',
+            old_name='bag_json',
+            new_name='bag',
+        ),
+        migrations.RenameField(
+            model_name='brickandmortruser',
+            old_name='favorites_json',
+            new_name='favorites',
+        ),
+        migrations.RenameField(
+            model_name='brickandmortruser',
+            old_name='preferences_json',
+            new_name='preferences',
+        ),
+        # The columns hold json.dumps output, which casts to jsonb as is
+        migrations.AlterField(
+            model_name='brickandmortruser',
+            name='bag',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=list),
+        ),
+        migrations.AlterField(
+            model_name='brickandmortruser',
+            name='favorites',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=list),
+        ),
+        migrations.AlterField(
+            model_name='brickandmortruser',
+            name='preferences',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+    ]
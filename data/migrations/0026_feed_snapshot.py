@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0025_user_data_jsonb'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('etag', models.CharField(max_length=100)),
+                ('payload', models.TextField()),
+                ('built_on', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -4,7 +4,7 @@ from __future__ import unicode_literals
 import datetime
 
 from django.contrib.auth.models import AbstractUser
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.db import models
 
 CLOTHING_CATEGORIES = (
@@ -30,6 +30,12 @@ class Store(models.Model):
     thumbnail = models.TextField()
     hours = ArrayField(ArrayField(models.IntegerField()))
 
+    class Meta:
+        # Radius searches narrow stores to a lat/lon bounding box before computing distances
+        indexes = [
+            models.Index(fields=['lat', 'lon']),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -46,6 +52,7 @@ class Designer(models.Model):
 class SubCategory(models.Model):
     display_name = models.TextField()
     parent_category = models.CharField(max_length=1, choices=CLOTHING_CATEGORIES, default="c")
+    item_count = models.IntegerField(default=0)
 
     class Meta:
         verbose_name = "Subcategories"
@@ -54,11 +61,26 @@ class SubCategory(models.Model):
         return self.display_name
 
 
+class SubCategorySize(models.Model):
+    """
+    Number of items in a subcategory carrying each size, kept up to date by the Item signals in data.signals
+    """
+    subcategory = models.ForeignKey(SubCategory, on_delete=models.CASCADE, related_name='sizes')
+    size = models.CharField(max_length=20)
+    item_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('subcategory', 'size')
+
+    def __str__(self):
+        return "%s %s" % (self.subcategory, self.size)
+
+
 class Item(models.Model):
     name = models.CharField(max_length=100)
     sku = models.TextField()
     upc = models.TextField()
-    price = models.CharField(max_length=100)
+    price = models.DecimalField(max_digits=10, decimal_places=2, db_index=True)
     images = ArrayField(models.TextField())
     store = models.ForeignKey(Store, on_delete=models.CASCADE)
     designer = models.ForeignKey(Designer, on_delete=models.CASCADE)
@@ -68,10 +90,22 @@ class Item(models.Model):
     thumbnail = models.TextField()
     sizes = ArrayField(models.CharField(max_length=20))
     sale = models.BooleanField(default=False)
-    old_price = models.CharField(max_length=100, default="", null=True, blank=True)
+    old_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     added_on = models.DateTimeField(default=datetime.datetime.now())
     featured = models.BooleanField(default=False)
 
+    class Meta:
+        # Match the orderings list endpoints page through, so keyset pages are index range scans
+        indexes = [
+            models.Index(fields=['name', 'id']),
+            models.Index(fields=['-added_on', 'name', 'id']),
+            models.Index(fields=['-sale', 'name', 'id']),
+            models.Index(fields=['price', 'name', 'id']),
+            models.Index(fields=['-price', 'name', 'id']),
+            models.Index(fields=['store', 'name', 'id']),
+            models.Index(fields=['designer', 'name', 'id']),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -80,11 +114,37 @@ class BrickAndMortrUser(AbstractUser):
     name = models.CharField(max_length=100)
     lat = models.FloatField(default=32.7767)
     lon = models.FloatField(default=-96.7970)
-    bag_json = models.TextField(default="[]")
-    favorites_json = models.TextField(default="[]")
-    preferences_json = models.TextField(default="{}")
+    # Changed in place by the single-column UPDATEs in data.user_data
+    bag = JSONField(default=list)
+    favorites = JSONField(default=list)
+    preferences = JSONField(default=dict)
     password_reset_code = models.TextField(null=True, blank=True)
     password_reset_code_expires = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.username
+
+
+class CatalogVersion(models.Model):
+    """
+    Change counter for one catalog table, bumped by the model signals in data.signals and used for conditional GETs
+    """
+    table = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+    modified_on = models.DateTimeField()
+
+    def __str__(self):
+        return "%s %d" % (self.table, self.version)
+
+
+class FeedSnapshot(models.Model):
+    """
+    A pre-serialized JSON response built by data.home_feed, with the catalog ETag it was built from
+    """
+    name = models.CharField(max_length=100, unique=True)
+    etag = models.CharField(max_length=100)
+    payload = models.TextField()
+    built_on = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return unicode(value)
+    raise TypeError(repr(value))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only cursor pagination over the queryset's own ordering, with id appended as a tiebreaker.
+
+    The cursor holds the ordering values of the last row served, and the next page is every row after it in
+    that ordering, so each page is an index range scan of page_size rows and no count is run.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*self.ordering)
+        # A position that decodes but doesn't fit the ordering, e.g. a price that isn't a number, is as invalid as
+        # one that doesn't decode at all
+        try:
+            position = self.decode_cursor(request)
+            if position is not None:
+                queryset = queryset.filter(self.after(position))
+        except (TypeError, ValueError, ValidationError, InvalidOperation):
+            raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_ordering(self, queryset):
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            ordering.append('id')
+        return ordering
+
+    def after(self, position):
+        """
+        Q object for rows that sort after position, e.g. for ('-price', 'name', 'id') rows with a lower price, or
+        the same price and a later name, or the same price and name and a higher id
+        """
+        q = Q()
+        equal = {}
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            conditions = dict(equal)
+            conditions[name + lookup] = value
+            q |= Q(**conditions)
+            equal[name] = value
+        return q
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        position = [getattr(last, field.lstrip('-')) for field in self.ordering]
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   self.encode_cursor(position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param, "")
+        if not encoded:
+            return None
+        position = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise ValueError("Cursor position doesn't match the ordering")
+        return position
+
+    def encode_cursor(self, position):
+        return urlsafe_b64encode(json.dumps(position, default=_encode_value).encode('utf-8')).decode('ascii')
+
+
+class CatalogPagination(PageNumberPagination):
+    """
+    Page number pagination, or keyset pagination for clients that pass a cursor parameter (empty for the first
+    page) and then follow the next links
+    """
+    keyset_pagination_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_pagination_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_pagination_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super(CatalogPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super(CatalogPagination, self).get_paginated_response(data)
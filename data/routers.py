@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.utils import ConnectionDoesNotExist
+
+logger = logging.getLogger(__name__)
+
+# Models whose reads may be served by a replica. Everything else, users included, is read from the primary.
+CATALOG_MODELS = {'data.Item', 'data.Store', 'data.Designer', 'data.SubCategory', 'data.SubCategorySize',
+                  'data.CatalogVersion', 'data.FeedSnapshot'}
+
+_state = threading.local()
+# Replica alias -> time before which it is considered unavailable
+_down_until = {}
+
+
+def replicas():
+    """
+    Replica aliases and their weights from settings.DATABASE_REPLICAS, skipping replicas recently found down
+    """
+    now = time.time()
+    return [(alias, weight) for alias, weight in sorted(getattr(settings, 'DATABASE_REPLICAS', {}).items())
+            if weight > 0 and _down_until.get(alias, 0) <= now]
+
+
+def available(alias):
+    try:
+        connections[alias].ensure_connection()
+    except (DatabaseError, ConnectionDoesNotExist) as error:
+        logger.warning("Replica %s is unavailable, reading from %s: %s", alias, DEFAULT_DB_ALIAS, error)
+        _down_until[alias] = time.time() + getattr(settings, 'DATABASE_REPLICA_RETRY_SECONDS', 30)
+        return False
+    return True
+
+
+def choose_replica():
+    """
+    A weighted random available replica, or the primary when none is
+    """
+    candidates = replicas()
+    while candidates:
+        point = random.random() * sum(weight for _, weight in candidates)
+        for alias, weight in candidates:
+            point -= weight
+            if point < 0:
+                break
+        if available(alias):
+            return alias
+        candidates = [(other, weight) for other, weight in candidates if other != alias]
+    return DEFAULT_DB_ALIAS
+
+
+def pin_seconds():
+    return getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 15)
+
+
+def _pin_key(user_id):
+    return 'primary_pin:%s' % user_id
+
+
+def pin_cache():
+    """
+    The cache the pins are kept in, DATABASE_REPLICA_PIN_CACHE, which every worker has to share
+    """
+    alias = getattr(settings, 'DATABASE_REPLICA_PIN_CACHE', 'default')
+    pins = caches[alias]
+    if isinstance(pins, LocMemCache):
+        raise ImproperlyConfigured("DATABASE_REPLICA_PIN_CACHE %r is local to each process, so a user's pin would "
+                                   "only hold on the worker that served their write" % alias)
+    return pins
+
+
+def pin_user(user_id):
+    """
+    Send the user's reads to the primary for DATABASE_REPLICA_PIN_SECONDS, after they wrote
+    """
+    # A database cache writes through the router, and storing the pin mustn't count as the user's write
+    with internal_writes():
+        pin_cache().set(_pin_key(user_id), time.time(), pin_seconds())
+
+
+def user_pinned(user_id):
+    with internal_writes():
+        wrote_at = pin_cache().get(_pin_key(user_id))
+    return wrote_at is not None and time.time() - wrote_at < pin_seconds()
+
+
+def start_request(request=None):
+    _state.request = request
+    _state.wrote = False
+    _state.pinned_user = None
+    _state.replica = None
+
+
+def end_request():
+    """
+    Forget the request's replica and pinning, pinning its user if it wrote to the primary. Returns whether it wrote.
+    """
+    wrote = getattr(_state, 'wrote', False)
+    user = getattr(getattr(_state, 'request', None), 'user', None)
+    # Without replicas every read is from the primary anyway
+    if wrote and user is not None and user.is_authenticated and getattr(settings, 'DATABASE_REPLICAS', {}):
+        pin_user(user.pk)
+    start_request()
+    return wrote
+
+
+def pinned():
+    """
+    Whether this thread's reads must go to the primary, because it wrote or its request's user wrote recently
+    """
+    if getattr(_state, 'wrote', False):
+        return True
+    user = getattr(getattr(_state, 'request', None), 'user', None)
+    if user is None or not user.is_authenticated:
+        return False
+    # Checked once per request, DRF sets request.user once it has authenticated the request
+    if _state.pinned_user is None or _state.pinned_user[0] != user.pk:
+        _state.pinned_user = (user.pk, user_pinned(user.pk))
+    return _state.pinned_user[1]
+
+
+@contextmanager
+def internal_writes():
+    """
+    Writes in the block are bookkeeping done on the user's behalf, e.g. catalog versions and counts, so they don't
+    pin the request or its user to the primary
+    """
+    previous = getattr(_state, 'internal', False)
+    _state.internal = True
+    try:
+        yield
+    finally:
+        _state.internal = previous
+
+
+class ReplicaRouter(object):
+    """
+    Sends catalog reads to the replicas in settings.DATABASE_REPLICAS and everything else to the primary. A request
+    sticks to one replica, and reads after a write go to the primary so users see their own changes, for the rest
+    of the request and for the user's requests over the next DATABASE_REPLICA_PIN_SECONDS.
+    """
+
+    def db_for_read(self, model, **hints):
+        # The database cache's stand-in model has no label
+        label = getattr(model._meta, 'label', None)
+        if label not in CATALOG_MODELS or not getattr(settings, 'DATABASE_REPLICAS', {}) or pinned():
+            return DEFAULT_DB_ALIAS
+        if getattr(_state, 'replica', None) is None:
+            _state.replica = choose_replica()
+        return _state.replica
+
+    def db_for_write(self, model, **hints):
+        if not getattr(_state, 'internal', False):
+            _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS} | set(getattr(settings, 'DATABASE_REPLICAS', {}))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in getattr(settings, 'DATABASE_REPLICAS', {}):
+            return False
+        return None
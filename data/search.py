@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Q
+
+from data.search_index import get_index
+from data.util import fuzzy_match_many
+
+PYTHON = "python"
+TRIGRAM = "trigram"
+INDEX = "index"
+
+
+def search_backend():
+    return getattr(settings, 'CATALOG_SEARCH_BACKEND', PYTHON)
+
+
+def trigram_threshold():
+    return getattr(settings, 'CATALOG_SEARCH_TRIGRAM_THRESHOLD', 0.3)
+
+
+def search_q(model, field, search_term):
+    """
+    Return a Q object limiting model rows to those whose field fuzzy matches search_term.
+
+    The trigram backend compiles to the pg_trgm % operator, which the GIN indexes on the name columns serve. The
+    index backend scores a shortlist from the in-process n-gram index, and the python backend scores every row,
+    both with fuzzy_match_many.
+    """
+    if search_backend() == TRIGRAM:
+        return Q(**{field + '__trigram_similar': search_term})
+    if search_backend() == INDEX:
+        return Q(id__in=get_index(model, field).search(search_term))
+    rows = list(model.objects.values_list('id', field))
+    matches = fuzzy_match_many([value for _, value in rows], search_term)
+    return Q(id__in=[pk for (pk, _), match in zip(rows, matches) if match])
+
+
+def rank(queryset, field, search_term):
+    """
+    Order queryset by trigram similarity to search_term, best match first. The other backends have no score to
+    order by, so the queryset is returned unchanged.
+    """
+    if search_backend() != TRIGRAM:
+        return queryset
+    ordering = ['-similarity'] + list(queryset.query.order_by)
+    return queryset.annotate(similarity=TrigramSimilarity(field, search_term)).order_by(*ordering)
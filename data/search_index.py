@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import math
+import threading
+import time
+from collections import defaultdict, Counter
+
+from django.conf import settings
+from fuzzywuzzy import utils
+
+from data.util import fuzzy_match_many, FUZZY_MATCH_THRESHOLD
+
+# fuzz.ratio rounds 200 * matches / (len1 + len2), so a match needs at least this share of the combined length
+MIN_MATCH_SHARE = (FUZZY_MATCH_THRESHOLD - 0.5) / 200.0
+
+
+def analyze(text):
+    """
+    Split text the way token_set_ratio does, returning its token set and the sorted token string it compares
+    """
+    tokens = set(utils.full_process(text or "", force_ascii=True).split())
+    return tokens, " ".join(sorted(tokens))
+
+
+def char_grams(string):
+    """
+    One gram per character occurrence, so the grams two strings share count the characters they have in common
+    """
+    return [(char, n) for char, count in Counter(string).items() for n in range(1, count + 1)]
+
+
+class NGramIndex(object):
+    """
+    In-memory inverted index over one text field of a model, used to shortlist rows for fuzzy_match.
+
+    token_set_ratio >= 50 holds only when the strings share a whole token, or when the sorted token strings share
+    enough characters for fuzz.ratio to reach the threshold. The index keeps postings for both tokens and
+    character occurrences, so the shortlist is a superset of the matches and rescoring it gives the same result
+    as scanning every row.
+
+    Rows are added and removed by the model signals in data.signals. Those only fire in the process that made the
+    change, so the index is also rebuilt from the database once it is older than CATALOG_SEARCH_INDEX_TTL seconds.
+    """
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.texts = {}
+        self.lengths = {}
+        self.token_postings = defaultdict(set)
+        self.char_postings = defaultdict(set)
+        self.built_at = None
+        self.lock = threading.RLock()
+
+    def add(self, pk, text):
+        with self.lock:
+            self.remove(pk)
+            tokens, string = analyze(text)
+            self.texts[pk] = text
+            self.lengths[pk] = len(string)
+            for token in tokens:
+                self.token_postings[token].add(pk)
+            for gram in char_grams(string):
+                self.char_postings[gram].add(pk)
+
+    def remove(self, pk):
+        with self.lock:
+            text = self.texts.pop(pk, None)
+            if text is None:
+                return
+            del self.lengths[pk]
+            tokens, string = analyze(text)
+            for postings, keys in ((self.token_postings, tokens), (self.char_postings, char_grams(string))):
+                for key in keys:
+                    postings[key].discard(pk)
+                    if not postings[key]:
+                        del postings[key]
+
+    def build(self):
+        with self.lock:
+            self.texts = {}
+            self.lengths = {}
+            self.token_postings = defaultdict(set)
+            self.char_postings = defaultdict(set)
+            for pk, text in self.model.objects.values_list('id', self.field).iterator():
+                self.add(pk, text)
+            self.built_at = time.time()
+
+    def ensure_built(self):
+        ttl = getattr(settings, 'CATALOG_SEARCH_INDEX_TTL', 300)
+        if self.built_at is None or time.time() - self.built_at > ttl:
+            self.build()
+
+    def candidates(self, search_term):
+        tokens, string = analyze(search_term)
+        if not tokens:
+            return {}
+        self.ensure_built()
+        with self.lock:
+            ids = set()
+            for token in tokens:
+                ids.update(self.token_postings.get(token, ()))
+
+            # A row can't share more characters than it has, which bounds its length and so the fewest characters
+            # it must share. Any row sharing that many is in the postings of one of the rarest len - minimum + 1
+            # grams, so only those are scanned for candidates, which are then checked against all the grams.
+            grams = sorted(char_grams(string), key=lambda gram: len(self.char_postings.get(gram, ())))
+            minimum = int(math.ceil(MIN_MATCH_SHARE * len(string) / (1 - MIN_MATCH_SHARE) - 1e-9))
+            shortlist = set()
+            for gram in grams[:len(grams) - max(minimum, 1) + 1]:
+                shortlist.update(self.char_postings.get(gram, ()))
+            for pk in shortlist - ids:
+                shared = sum(1 for gram in grams if pk in self.char_postings.get(gram, ()))
+                if shared >= MIN_MATCH_SHARE * (len(string) + self.lengths[pk]) - 1e-9:
+                    ids.add(pk)
+            return {pk: self.texts[pk] for pk in ids}
+
+    def search(self, search_term):
+        """
+        Ids of rows whose field fuzzy matches search_term
+        """
+        candidates = list(self.candidates(search_term).items())
+        matches = fuzzy_match_many([text for _, text in candidates], search_term)
+        return [pk for (pk, _), match in zip(candidates, matches) if match]
+
+
+_indexes = {}
+
+
+def get_index(model, field):
+    key = (model, field)
+    if key not in _indexes:
+        _indexes[key] = NGramIndex(model, field)
+    return _indexes[key]
+
+
+def indexes_for(model):
+    return [index for (indexed_model, field), index in _indexes.items() if indexed_model is model]
+
+
+def expire_indexes():
+    """
+    Force every index to rebuild on next use, for writes that bypass model signals such as bulk_create
+    """
+    for index in _indexes.values():
+        index.built_at = None
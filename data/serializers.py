@@ -1,35 +1,216 @@
+from collections import OrderedDict
+
 from rest_framework import serializers
 
 from data.models import Item, Store, BrickAndMortrUser, Designer, SubCategory
+from data.timing import section
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with section('serialize'):
+            return super(TimedListSerializer, self).data
+
+
+class TimedSerializerMixin(object):
+    """
+    Counts top-level serialization towards the serialize section of ServerTimingMiddleware. Nested serializers
+    are built through to_representation rather than data, so they aren't counted twice.
+    """
+
+    class Meta:
+        list_serializer_class = TimedListSerializer
+
+    @property
+    def data(self):
+        with section('serialize'):
+            return super(TimedSerializerMixin, self).data
 
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = BrickAndMortrUser
-        fields = ('id', 'username', 'is_staff', 'favorites_json', 'bag_json')
+        fields = ('id', 'username', 'is_staff', 'favorites', 'bag')
 
 
-class SubCategorySerializer(serializers.ModelSerializer):
-    class Meta:
+class SubCategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta(TimedSerializerMixin.Meta):
         model = SubCategory
         fields = ('id', 'display_name', 'parent_category')
 
 
 class ItemSerializer(serializers.ModelSerializer):
+    subcategory = SubCategorySerializer(read_only=True)
+
     class Meta:
         model = Item
         depth = 1
         fields = ('id', 'name', 'sku', 'upc', 'price', 'images', 'store', 'category', 'subcategory', 'designer',
                   'thumbnail', 'sizes', 'sale', 'old_price', 'added_on')
 
+    def to_representation(self, item):
+        data = super(ItemSerializer, self).to_representation(item)
+        # Items without an old price have always had "" here, from before old_price was a DecimalField
+        if data['old_price'] is None:
+            data['old_price'] = ""
+        return data
 
-class StoreSerializer(serializers.ModelSerializer):
-    class Meta:
+
+class StoreSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta(TimedSerializerMixin.Meta):
         model = Store
         fields = ('id', 'lat', 'lon', 'name', 'address', 'contact_email', 'contact_phone', 'thumbnail', 'hours')
 
 
-class DesignerSerializer(serializers.ModelSerializer):
-    class Meta:
+class StoreDistanceSerializer(StoreSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta(StoreSerializer.Meta):
+        fields = StoreSerializer.Meta.fields + ('distance',)
+
+
+class DesignerSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta(TimedSerializerMixin.Meta):
         model = Designer
         fields = ('id', 'name', 'category', 'image')
+
+
+# Relations every item representation embeds, fetched in the item query rather than once per item
+ITEM_RELATED = ('store', 'designer', 'subcategory')
+ITEM_FIELDS = ('id', 'name', 'sku', 'upc', 'price', 'images', 'store', 'category', 'subcategory', 'designer',
+               'thumbnail', 'sizes', 'sale', 'old_price', 'added_on')
+# Keys of the side-loaded map of each relation in "included" mode
+INCLUDED_KEYS = OrderedDict([('store', 'stores'), ('designer', 'designers'), ('subcategory', 'subcategories')])
+
+
+def requested_item_fields(request):
+    """
+    The item fields a request asked for with ?fields=, in ITEM_FIELDS order, or all of them
+    """
+    param = request.query_params.get('fields', '')
+    if not param:
+        return ITEM_FIELDS
+    names = set(name.strip() for name in param.split(',') if name.strip())
+    if not names:
+        raise serializers.ValidationError({'fields': ["Expected a comma separated list of item fields."]})
+    unknown = names.difference(ITEM_FIELDS)
+    if unknown:
+        raise serializers.ValidationError({'fields': ["Unknown item fields: %s." % ", ".join(sorted(unknown))]})
+    return tuple(name for name in ITEM_FIELDS if name in names)
+
+
+class ItemReadSerializer(TimedSerializerMixin, serializers.BaseSerializer):
+    """
+    Read-only serializer giving the same output as ItemSerializer, built by hand instead of through one DRF field
+    per attribute. Store, designer and subcategory representations are reused across the items of a page.
+    Querysets should select_related(*ITEM_RELATED).
+
+    The context may limit items to a tuple of "fields", and with "included" set, relations are given as ids
+    with their representations collected once each in self.included.
+    """
+    price_field = serializers.DecimalField(max_digits=10, decimal_places=2)
+    added_on_field = serializers.DateTimeField()
+
+    def __init__(self, *args, **kwargs):
+        super(ItemReadSerializer, self).__init__(*args, **kwargs)
+        self.related = {}
+        self.field_names = self.context.get('fields', ITEM_FIELDS)
+        self.included = None
+        if self.context.get('included'):
+            self.included = OrderedDict((key, OrderedDict()) for name, key in INCLUDED_KEYS.items()
+                                        if name in self.field_names)
+
+    def _related(self, obj, represent):
+        if obj is None:
+            return None
+        key = (type(obj), obj.pk)
+        if key not in self.related:
+            self.related[key] = represent(obj)
+        return self.related[key]
+
+    def _reference(self, name, obj, represent):
+        # The object's id, after adding its representation to the included map
+        if obj is None:
+            return None
+        included = self.included[INCLUDED_KEYS[name]]
+        if unicode(obj.pk) not in included:
+            included[unicode(obj.pk)] = represent(obj)
+        return obj.pk
+
+    def store(self, store):
+        return OrderedDict([
+            ('id', store.id),
+            ('lat', store.lat),
+            ('lon', store.lon),
+            ('name', store.name),
+            ('address', store.address),
+            ('contact_email', store.contact_email),
+            ('contact_phone', store.contact_phone),
+            ('thumbnail', store.thumbnail),
+            ('hours', [list(day) for day in store.hours]),
+        ])
+
+    def designer(self, designer):
+        return OrderedDict([
+            ('id', designer.id),
+            ('category', designer.category),
+            ('name', designer.name),
+            ('image', designer.image),
+        ])
+
+    def subcategory(self, subcategory):
+        return OrderedDict([
+            ('id', subcategory.id),
+            ('display_name', subcategory.display_name),
+            ('parent_category', subcategory.parent_category),
+        ])
+
+    def to_representation(self, item):
+        if self.field_names is not ITEM_FIELDS or self.included is not None:
+            return OrderedDict((name, self.field(item, name)) for name in self.field_names)
+        return OrderedDict([
+            ('id', item.id),
+            ('name', item.name),
+            ('sku', item.sku),
+            ('upc', item.upc),
+            ('price', None if item.price is None else self.price_field.to_representation(item.price)),
+            ('images', list(item.images)),
+            ('store', self._related(item.store, self.store)),
+            ('category', item.category),
+            ('subcategory', self._related(item.subcategory, self.subcategory)),
+            ('designer', self._related(item.designer, self.designer)),
+            ('thumbnail', item.thumbnail),
+            ('sizes', list(item.sizes)),
+            ('sale', item.sale),
+            ('old_price', "" if item.old_price is None else self.price_field.to_representation(item.old_price)),
+            ('added_on', self.added_on_field.to_representation(item.added_on)),
+        ])
+
+    def field(self, item, name):
+        """
+        One field of the item, for sparse and side-loaded representations
+        """
+        if name in INCLUDED_KEYS:
+            represent = getattr(self, name)
+            related = getattr(item, name)
+            if self.included is not None:
+                return self._reference(name, related, represent)
+            return self._related(related, represent)
+        value = getattr(item, name)
+        if value is None:
+            return "" if name == 'old_price' else None
+        if name in ('price', 'old_price'):
+            return self.price_field.to_representation(value)
+        if name == 'added_on':
+            return self.added_on_field.to_representation(value)
+        if name in ('images', 'sizes'):
+            return list(value)
+        return value
+
+
+class NearbyDesignerSerializer(DesignerSerializer):
+    nearby_store_count = serializers.IntegerField(read_only=True)
+
+    class Meta(DesignerSerializer.Meta):
+        fields = DesignerSerializer.Meta.fields + ('nearby_store_count',)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from oauth2_provider.models import AccessToken
+from rest_framework_api_key.models import APIKey
+
+from data import auth, subcategories
+from data.caching import bump_versions
+from data.models import BrickAndMortrUser, Item, Designer, Store, SubCategory
+from data.search_index import indexes_for
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Designer)
+@receiver(post_save, sender=Store)
+def update_search_indexes(sender, instance, **kwargs):
+    for index in indexes_for(sender):
+        if index.built_at is not None:
+            index.add(instance.pk, getattr(instance, index.field))
+
+
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Designer)
+@receiver(post_delete, sender=Store)
+def remove_from_search_indexes(sender, instance, **kwargs):
+    for index in indexes_for(sender):
+        index.remove(instance.pk)
+
+
+@receiver(pre_save, sender=Item)
+def remember_subcategory_sizes(sender, instance, **kwargs):
+    previous = None
+    if instance.pk is not None:
+        previous = Item.objects.filter(pk=instance.pk).values_list('subcategory_id', 'sizes').first()
+    instance._previous_subcategory_sizes = previous
+
+
+@receiver(post_save, sender=Item)
+def update_subcategory_sizes(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_subcategory_sizes', None)
+    current = (instance.subcategory_id, sorted(set(instance.sizes or [])))
+    if previous is not None and (previous[0], sorted(set(previous[1] or []))) == current:
+        return
+    if previous is not None:
+        subcategories.adjust_counts(previous[0], previous[1], -1)
+    subcategories.adjust_counts(current[0], current[1], 1)
+
+
+@receiver(post_delete, sender=Item)
+def remove_subcategory_sizes(sender, instance, **kwargs):
+    subcategories.adjust_counts(instance.subcategory_id, instance.sizes, -1)
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Designer)
+@receiver(post_save, sender=Store)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Designer)
+@receiver(post_delete, sender=Store)
+@receiver(post_delete, sender=SubCategory)
+def bump_catalog_version(sender, **kwargs):
+    bump_versions(sender)
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def forget_access_token(sender, instance, **kwargs):
+    auth.forget_access_token(instance.token)
+
+
+@receiver(post_save, sender=BrickAndMortrUser)
+@receiver(post_delete, sender=BrickAndMortrUser)
+def forget_user_tokens(sender, instance, **kwargs):
+    auth.forget_user(instance.pk)
+
+
+@receiver(post_save, sender=APIKey)
+@receiver(post_delete, sender=APIKey)
+def forget_api_key(sender, instance, **kwargs):
+    auth.forget_api_key(instance.key)
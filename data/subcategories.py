@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+from data.caching import bump_versions
+from data.models import SubCategory, SubCategorySize
+from data.routers import internal_writes
+
+REBUILD_SQL = """
+UPDATE data_subcategory SET item_count = 0;
+UPDATE data_subcategory s SET item_count = counts.item_count
+FROM (SELECT subcategory_id, COUNT(*) AS item_count FROM data_item WHERE subcategory_id IS NOT NULL
+      GROUP BY subcategory_id) counts
+WHERE s.id = counts.subcategory_id;
+DELETE FROM data_subcategorysize;
+INSERT INTO data_subcategorysize (subcategory_id, size, item_count)
+SELECT subcategory_id, size, COUNT(DISTINCT id) FROM data_item, unnest(sizes) AS size
+WHERE subcategory_id IS NOT NULL GROUP BY subcategory_id, size;
+"""
+
+
+def adjust_counts(subcategory_id, sizes, delta):
+    """
+    Add delta items to a subcategory's item count and to the count of each of the given sizes
+    """
+    if subcategory_id is None:
+        return
+    with internal_writes():
+        SubCategory.objects.filter(id=subcategory_id).update(item_count=F('item_count') + delta)
+        for size in set(sizes or []):
+            rows = SubCategorySize.objects.filter(subcategory_id=subcategory_id, size=size)
+            if rows.update(item_count=F('item_count') + delta) or delta < 0:
+                continue
+            try:
+                with transaction.atomic():
+                    SubCategorySize.objects.create(subcategory_id=subcategory_id, size=size, item_count=delta)
+            except IntegrityError:
+                # Another request created the row first
+                rows.update(item_count=F('item_count') + delta)
+        if delta < 0:
+            SubCategorySize.objects.filter(subcategory_id=subcategory_id, item_count__lte=0).delete()
+
+
+def rebuild_counts():
+    """
+    Recompute every subcategory and size count from the items, for writes that bypass the Item signals
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(REBUILD_SQL)
+    bump_versions(SubCategory)
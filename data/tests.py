@@ -3,12 +3,50 @@ from __future__ import unicode_literals
 
 import datetime
 import json
+import math
+import random
+from base64 import urlsafe_b64encode
 
+import psycopg2
+from django.conf import settings
+from django.core.cache import _create_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from oauth2_provider.models import AccessToken, Application
+from prometheus_client import REGISTRY
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework_api_key.models import APIKey
 
-from data.models import BrickAndMortrUser, Item, Store, Designer, SubCategory
+from data import home_feed, routers, user_data
+from data.backends.postgresql_pooled.pool import ConnectionPool
+from data.caching import bump_versions
+from data.filters import filter_items
+from data.geo import bounding_box, nearest_store_ids, MAX_NEAREST_STORES
+from data.middleware import MetricsMiddleware
+from data.models import BrickAndMortrUser, FeedSnapshot, Item, Store, Designer, SubCategory
+from data.search_index import get_index, expire_indexes
+from data.serializers import ItemSerializer, ItemReadSerializer
+from data.subcategories import rebuild_counts
+from data.timing import capture_timings, percentile
+from data.util import fuzzy_match, fuzzy_match_many, distance, haversine, batch_haversine, EARTH_RADIUS_MILES
+
+
+def destination(lat, lon, miles, bearing):
+    """
+    Point miles away from lat, lon along bearing degrees
+    """
+    lat, lon, bearing = math.radians(lat), math.radians(lon), math.radians(bearing)
+    angle = float(miles) / EARTH_RADIUS_MILES
+    point_lat = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing))
+    point_lon = lon + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat),
+                                 math.cos(angle) - math.sin(lat) * math.sin(point_lat))
+    return math.degrees(point_lat), math.degrees(point_lon)
 
 
 class UserTests(APITestCase):
@@ -99,6 +137,86 @@ class UserTests(APITestCase):
         response = self.client.get('/data/users/favorites', {}, format='json')
         self.assertEqual(response.content, '["item 1"]')
 
+    def test_patch_user_data(self):
+        self.client.force_authenticate(user=self.user)
+        other_device = BrickAndMortrUser.objects.get(id=self.user.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch('/data/users/bag', {"op": "add", "value": "item 1"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The update should only touch the bag column
+        update = [query["sql"] for query in queries.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(update), 1)
+        self.assertNotIn("password", update[0])
+        # Operations from a device holding a stale copy of the user should not lose the other device's changes
+        user_data.apply_operation(other_device, 'bag', {"op": "add", "value": "item 2"})
+        self.client.patch('/data/users/bag', {"op": "add", "value": "item 1"}, format='json')
+        self.assertEqual(self.client.get('/data/users/bag').data, ["item 1", "item 2"])
+        self.client.patch('/data/users/bag', {"op": "remove", "value": "item 1"}, format='json')
+        self.assertEqual(self.client.get('/data/users/bag').data, ["item 2"])
+
+        self.client.patch('/data/users/preferences', {"op": "set", "key": "size", "value": "small"}, format='json')
+        self.client.patch('/data/users/preferences', {"op": "set", "key": "category", "value": "c"}, format='json')
+        self.client.patch('/data/users/preferences', {"op": "remove", "key": "size"}, format='json')
+        self.assertEqual(self.client.get('/data/users/preferences').data, {"category": "c"})
+
+        response = self.client.patch('/data/users/favorites', {"op": "set", "key": "size"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # An entry should only count as present when it is equal, not when it merely contains the new one
+        self.client.post('/data/users/favorites', [{"id": 1, "quantity": 2}], format='json')
+        self.client.patch('/data/users/favorites', {"op": "add", "value": {"id": 1}}, format='json')
+        self.client.patch('/data/users/favorites', {"op": "add", "value": {"id": 1}}, format='json')
+        self.assertEqual(self.client.get('/data/users/favorites').data, [{"id": 1, "quantity": 2}, {"id": 1}])
+
+        # Fields replaced with the wrong JSON type should refuse operations rather than fail
+        user_data.replace(self.user, 'bag', {"id": 1})
+        response = self.client.patch('/data/users/bag', {"op": "add", "value": "item 1"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        user_data.replace(self.user, 'preferences', ["small"])
+        response = self.client.patch('/data/users/preferences', {"op": "set", "key": "size", "value": "small"},
+                                     format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_auth_cache(self):
+        application = Application.objects.create(user=self.user, client_type=Application.CLIENT_CONFIDENTIAL,
+                                                 authorization_grant_type=Application.GRANT_PASSWORD)
+        token = AccessToken.objects.create(user=self.user, application=application, token="token", scope="read write",
+                                           expires=timezone.now() + datetime.timedelta(hours=1))
+        headers = {"HTTP_AUTHORIZATION": "Bearer token"}
+        response = self.client.get('/data/users/bag', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Once cached, the token and its user should cost no queries, leaving only the one reading the bag
+        with self.assertNumQueries(1):
+            response = self.client.get('/data/users/bag', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Revoking the token should take effect immediately
+        token.delete()
+        response = self.client.get('/data/users/bag', **headers)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_hydrated_bag(self):
+        self.client.force_authenticate(user=self.user)
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[])
+        designer = Designer.objects.create(name="test designer", image="url")
+        items = [Item.objects.create(name="item %d" % i, sku="666", upc="777", price=price, images=["url.com"],
+                                     store=store, designer=designer, designer_name=designer.name,
+                                     thumbnail="url.com", sizes=["small"], sale=i == 1, old_price="50.00")
+                 for i, price in enumerate(["30.00", "12.50"])]
+        bag = [items[1].id, {"id": unicode(items[0].id), "quantity": 2}, items[1].id + 1000, "item 1"]
+        self.client.post('/data/users/bag', bag, format='json')
+        # Stale entries should be dropped and every item fetched in one query, after the one reading the bag
+        with self.assertNumQueries(2):
+            response = self.client.get('/data/users/bag', {"hydrate": "1"})
+        self.assertEqual([item["id"] for item in response.data["results"]], [items[1].id, items[0].id])
+        self.assertEqual(response.data["results"][0]["store"]["name"], "test store")
+        self.assertTrue(response.data["results"][0]["sale"])
+        self.assertEqual(response.data["subtotal"], "72.50")
+        # Only 1 and true should hydrate
+        response = self.client.get('/data/users/bag', {"hydrate": "0"})
+        self.assertEqual(len(response.data), 4)
+        response = self.client.get('/data/users/bag', {"hydrate": "true"})
+        self.assertIn("subtotal", response.data)
+
 
 class ItemTests(APITestCase):
     def setUp(self):
@@ -255,6 +373,301 @@ class ItemTests(APITestCase):
         response = self.client.get('/data/items/?query_params=' + json.dumps(p2), **headers)
         self.assertEqual(response.data["count"], 0)
 
+    def test_list_single_query(self):
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
+                                     contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                     hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url.com")
+        subcategory = SubCategory.objects.create(display_name="Denim Jackets")
+        for i in range(20):
+            Item.objects.create(name="Item " + unicode(i), sku="123", upc="234", price=unicode(10 + i),
+                                images=["url.com"], store=store, designer=designer, category="c",
+                                subcategory=subcategory, designer_name=designer.name, thumbnail="thumbnail_url.com",
+                                sizes=["small", "medium"] if i % 2 else [])
+        params = {
+            "categories": ["c"],
+            "designers": [designer.id],
+            "stores": [store.id],
+            "subcategories": [{"id": subcategory.id}, {"id": subcategory.id, "sizes": ["small"]}],
+            "price": {"min": "12.00", "max": "25.00"},
+            "sort": "price_high"
+        }
+
+        # All filters and the sort should compile into one SQL statement
+        with self.assertNumQueries(1):
+            items = list(filter_items(params))
+        self.assertEqual([item.name for item in items], ["Item " + unicode(i) for i in (15, 13, 11, 9, 7, 5, 3)])
+
+    def test_price_numeric(self):
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
+                                     contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                     hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url.com")
+        for name, price in (("Cheap Item", "9.5"), ("Mid Item", "10.00"), ("Expensive Item", "100")):
+            Item.objects.create(name=name, sku="123", upc="234", price=price, images=["url.com"], store=store,
+                                designer=designer, category="c", designer_name=designer.name,
+                                thumbnail="thumbnail_url.com", sizes=["small"])
+        headers = {
+            "HTTP_API_KEY": "testing"
+        }
+
+        # Prices should sort and filter numerically and serialize with two decimal places
+        response = self.client.get('/data/items/?query_params=' + json.dumps({"sort": "price_low"}), **headers)
+        self.assertEqual([item["price"] for item in response.data["results"]], ["9.50", "10.00", "100.00"])
+        p1 = {
+            "price": {
+                "min": 9.75,
+                "max": "99"
+            }
+        }
+        response = self.client.get('/data/items/?query_params=' + json.dumps(p1), **headers)
+        self.assertEqual(response.data["count"], 1)
+        self.assertEqual(response.data["results"][0]["name"], "Mid Item")
+
+    def test_cursor_pagination(self):
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
+                                     contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                     hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url.com")
+        now = datetime.datetime.now()
+        # Repeated names, prices and dates so every sort has ties the id tiebreaker has to settle
+        for i in range(25):
+            Item.objects.create(name="Item " + unicode(i % 4), sku="123", upc="234", price=unicode(10 + i % 3),
+                                images=["url.com"], store=store, designer=designer, category="c",
+                                designer_name=designer.name, thumbnail="thumbnail_url.com", sizes=["small"],
+                                sale=i % 2 == 0, added_on=now - datetime.timedelta(minutes=i % 5))
+        headers = {
+            "HTTP_API_KEY": "testing"
+        }
+
+        # Following next links from an empty cursor should walk every item once, in sort order with ties by id
+        for sort in ["", "new_items", "sale", "price_low", "price_high"]:
+            query = 'query_params=' + json.dumps({"sort": sort})
+            items = filter_items({"sort": sort})
+            expected = list(items.order_by(*(list(items.query.order_by) + ['id'])).values_list('id', flat=True))
+            walked = []
+            url = '/data/items/?cursor=&' + query
+            while url:
+                response = self.client.get(url, **headers)
+                self.assertNotIn("count", response.data)
+                walked.extend(item["id"] for item in response.data["results"])
+                url = response.data["next"]
+            self.assertEqual(walked, expected)
+
+        response = self.client.get('/data/stores/' + unicode(store.id) + '/items/?cursor=', **headers)
+        self.assertEqual(len(response.data["results"]), 10)
+        response = self.client.get(response.data["next"], **headers)
+        self.assertEqual(len(response.data["results"]), 10)
+        response = self.client.get('/data/items/?cursor=garbage', **headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # Cursors that decode but don't fit the ordering, here ('-added_on', 'name', 'id'), aren't found either
+        query = '&query_params=' + json.dumps({"sort": "new_items"})
+        for position in [{"id": 1}, 5, ["Item 1", 1], ["2017-01-01T00:00:00", "Item 1", 1, 4],
+                         ["yesterday", "Item 1", 1], ["2017-01-01T00:00:00", "Item 1", "one"],
+                         ["2017-01-01T00:00:00", "Item 1", [1]]]:
+            cursor = urlsafe_b64encode(json.dumps(position))
+            response = self.client.get('/data/items/?cursor=' + cursor + query, **headers)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/data/items/?cursor=' + urlsafe_b64encode('["2017-01-01T00:00:00", "Item 1", 1]')
+                                   + query, **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        query = '&query_params=' + json.dumps({"sort": "price_low"})
+        cursor = urlsafe_b64encode('["ten", "Item 1", 1]')
+        response = self.client.get('/data/items/?cursor=' + cursor + query, **headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_facets(self):
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
+                                     contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                     hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        store2 = Store.objects.create(lat=30.00, lon=90.00, name="test store2", address="123 test st",
+                                      contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                      hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url.com")
+        designer2 = Designer.objects.create(name="test designer2", image="url2.com")
+        jackets = SubCategory.objects.create(display_name="Denim Jackets")
+        boots = SubCategory.objects.create(display_name="Boots", parent_category="s")
+        for i in range(12):
+            Item.objects.create(name="Item " + unicode(i), sku="123", upc="234", price=unicode(10 + i),
+                                images=["url.com"], store=store if i % 3 else store2,
+                                designer=designer if i % 2 else designer2, category="c" if i < 8 else "s",
+                                subcategory=jackets if i < 8 else boots, designer_name=designer.name,
+                                thumbnail="thumbnail_url.com", sizes=["small", "large"] if i % 4 else ["medium"])
+        headers = {
+            "HTTP_API_KEY": "testing"
+        }
+        params = {
+            "categories": ["c"],
+            "designers": [designer.id],
+            "subcategories": [{"id": jackets.id, "sizes": ["small"]}],
+            "price": {"max": "20"}
+        }
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/data/items/facets?query_params=' + json.dumps(params), **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Each facet should count the items matching every other filter, as ItemList would return them
+        def expected(exclude, **extra):
+            facet_params = dict((key, value) for key, value in params.items() if key not in exclude)
+            facet_params.update(extra)
+            return self.client.get('/data/items/?query_params=' + json.dumps(facet_params), **headers).data["count"]
+
+        for value in ("c", "s"):
+            count = expected(("categories",), categories=[value])
+            self.assertEqual([f["count"] for f in response.data["categories"] if f["value"] == value] or [0], [count])
+        for value in (designer.id, designer2.id):
+            count = expected(("designers",), designers=[value])
+            self.assertEqual([f["count"] for f in response.data["designers"] if f["value"] == value] or [0], [count])
+        for value in (store.id, store2.id):
+            count = expected((), stores=[value])
+            self.assertEqual([f["count"] for f in response.data["stores"] if f["value"] == value] or [0], [count])
+        for value in (jackets.id, boots.id):
+            count = expected(("subcategories",), subcategories=[{"id": value}])
+            self.assertEqual([f["count"] for f in response.data["subcategories"] if f["value"] == value] or [0],
+                             [count])
+        for value in ("small", "medium", "large"):
+            count = expected((), subcategories=[{"id": jackets.id, "sizes": [value]}])
+            self.assertEqual([f["count"] for f in response.data["sizes"] if f["value"] == value] or [0], [count])
+        self.assertEqual(response.data["price"], {"min": "11.00", "max": "17.00"})
+
+        response = self.client.get('/data/items/facets', **headers)
+        self.assertEqual(response.data["categories"], [{"value": "c", "count": 8}, {"value": "s", "count": 4}])
+        self.assertEqual(response.data["sizes"], [{"value": "large", "count": 9}, {"value": "medium", "count": 3},
+                                                  {"value": "small", "count": 9}])
+        self.assertEqual(response.data["price"], {"min": "10.00", "max": "21.00"})
+
+    def test_list_query_count(self):
+        headers = {
+            "HTTP_API_KEY": "testing"
+        }
+        subcategory = SubCategory.objects.create(display_name="Denim Jackets")
+        shared_store = Store.objects.create(lat=0, lon=0, hours=[])
+
+        def add_items(count):
+            for i in range(count):
+                store = Store.objects.create(lat=30.00, lon=90.00, name="store", address="123 test st",
+                                             contact_email="contact@test.com", contact_phone="1111111",
+                                             thumbnail="url.com", hours=[[8, 16], [8, 16]])
+                designer = Designer.objects.create(name="designer", image="url.com")
+                Item.objects.create(name="Item", sku="123", upc="234", price="10.5", images=["url.com"],
+                                    store=shared_store if i % 2 else store, designer=designer, category="c",
+                                    subcategory=subcategory if i % 2 else None, designer_name=designer.name,
+                                    thumbnail="url.com", sizes=["small"], sale=bool(i % 2),
+                                    old_price="12.00" if i % 2 else None)
+
+        def count_queries(path):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path, **headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        paths = ['/data/items/', '/data/items/?cursor=', '/data/items/featured',
+                 '/data/stores/%d/items/' % shared_store.id]
+        add_items(2)
+        # Cache the api key first, so every request below looks it up the same way
+        self.client.get(paths[0], **headers)
+        short_pages = [count_queries(path) for path in paths]
+        add_items(20)
+        # Related objects should be fetched with the items, so a full page costs no more queries than a short one
+        self.assertEqual([count_queries(path) for path in paths], short_pages)
+
+        # The hand-written read serializer should give exactly the ModelSerializer output
+        items = Item.objects.select_related('store', 'designer', 'subcategory').order_by('id')
+        self.assertEqual(json.loads(json.dumps(ItemReadSerializer(items, many=True).data)),
+                         json.loads(json.dumps(ItemSerializer(items, many=True).data)))
+
+    def test_generate_catalog(self):
+        def generate():
+            call_command('generate_catalog', items=300, stores=10, designers=5, seed=3, batch_size=100,
+                         stdout=StringIO())
+            items = Item.objects.order_by('id')
+            return list(items.values_list('name', 'price', 'sizes', 'store__lat', 'designer__name'))
+
+        first = generate()
+        self.assertEqual(len(first), 300)
+        self.assertEqual(Store.objects.count(), 10)
+        # Counts maintained by signals should be rebuilt after the bulk load
+        self.assertEqual(sum(SubCategory.objects.values_list('item_count', flat=True)), 300)
+        Item.objects.all().delete()
+        Store.objects.all().delete()
+        Designer.objects.all().delete()
+        # The same seed should generate the same catalog
+        self.assertEqual(generate(), first)
+
+    def test_sparse_fields(self):
+        headers = {"HTTP_API_KEY": "testing"}
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[[8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url")
+        for i in range(3):
+            Item.objects.create(name="item %d" % i, sku="666", upc="777", price="10.00", images=["url"], store=store,
+                                designer=designer, designer_name=designer.name, thumbnail="url", sizes=["small"])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/data/items/?cursor=&fields=price,id,name', **headers)
+        self.assertEqual([item.keys() for item in response.data["results"]], [["id", "name", "price"]] * 3)
+        # Relations left out should not be joined, nor other columns loaded
+        self.assertNotIn('"data_store"', queries.captured_queries[-1]["sql"])
+        self.assertNotIn('"sku"', queries.captured_queries[-1]["sql"])
+        self.assertEqual(len(queries), 2)
+
+        response = self.client.get('/data/stores/%d/items/?fields=id,store,designer&included=true' % store.id,
+                                   **headers)
+        self.assertEqual({item["store"] for item in response.data["results"]}, {store.id})
+        self.assertEqual(response.data["included"].keys(), ["stores", "designers"])
+        self.assertEqual(response.data["included"]["stores"][unicode(store.id)]["hours"], [[8, 16]])
+
+        for fields in ["id,hours", ",", " ", " , "]:
+            response = self.client.get('/data/items/', {"fields": fields}, **headers)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("fields", response.data)
+
+    def test_home_feed(self):
+        home_feed.expire()
+        headers = {"HTTP_API_KEY": "testing"}
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[])
+        designer = Designer.objects.create(name="test designer", image="url")
+        for i, category in enumerate("ccsb"):
+            Item.objects.create(name="item %d" % i, sku="666", upc="777", price="%d.00" % (10 + i), images=["url"],
+                                store=store, designer=designer, category=category, designer_name=designer.name,
+                                thumbnail="url", sizes=["small"], sale=i == 2, featured=i == 3)
+        # Requests never build the feed, refresh_home_feed does
+        response = self.client.get('/data/home', **headers)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        call_command('refresh_home_feed', stdout=StringIO())
+        response = self.client.get('/data/home', **headers)
+        feed = json.loads(response.content)
+        self.assertEqual([item["name"] for item in feed["featured"]], ["item 3"])
+        self.assertEqual([item["name"] for item in feed["sale"]][0], "item 2")
+        self.assertEqual({category: len(items) for category, items in feed["categories"].items()},
+                         {"c": 2, "s": 1, "b": 1, "a": 0})
+        self.assertEqual(feed["new_items"][0]["store"], {"id": store.id, "lat": 30.0, "lon": 90.0,
+                                                         "name": "test store", "address": "", "contact_email": "",
+                                                         "contact_phone": "", "thumbnail": "", "hours": []})
+        # Unchanged, the feed should be served from memory after the catalog version lookup
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/data/home', **headers).content, response.content)
+        # After a change the stored snapshot should be served as it is, under its own ETag, until it is rebuilt
+        stale_etag = response['ETag']
+        Item.objects.filter(name="item 0").get().delete()
+        with self.assertNumQueries(2):
+            stale = self.client.get('/data/home', **headers)
+        self.assertEqual(stale.content, response.content)
+        self.assertEqual(stale['ETag'], stale_etag)
+        self.assertNotIn('Last-Modified', stale)
+        response = self.client.get('/data/home', HTTP_IF_NONE_MATCH=stale_etag, **headers)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(FeedSnapshot.objects.get().etag, stale_etag)
+        call_command('refresh_home_feed', stdout=StringIO())
+        response = self.client.get('/data/home', HTTP_IF_NONE_MATCH=stale_etag, **headers)
+        self.assertEqual(len(json.loads(response.content)["categories"]["c"]), 1)
+        self.assertNotEqual(response['ETag'], stale_etag)
+        # Other workers should serve the stored snapshot
+        home_feed.expire()
+        with self.assertNumQueries(2):
+            response = self.client.get('/data/home', **headers)
+        self.assertEqual(response.content, FeedSnapshot.objects.get().payload)
+
     def test_detail(self):
         store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
                                      contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
@@ -322,6 +735,89 @@ class StoreTests(APITestCase):
         self.assertEqual(response.data["count"], 1)
         self.assertEqual(response.data["results"][0]["id"], item.id)
 
+    def test_radius_search(self):
+        random.seed(7)
+        for i in range(200):
+            Store.objects.create(lat=random.uniform(29.0, 31.5), lon=random.uniform(-99.0, -96.5), name="store %d" % i,
+                                 hours=[])
+        for lat, lon, radius in [(30.27, -97.74, 10), (30.27, -97.74, 75), (29.5, -97.0, 0.5)]:
+            response = self.client.get('/data/stores/?lat=%s&lon=%s&radius=%s' % (lat, lon, radius), **self.headers)
+            expected = sorted((distance(lon, lat, store.lon, store.lat), store.id) for store in Store.objects.all()
+                              if haversine(lon, lat, store.lon, store.lat, radius))
+            self.assertEqual(response.data["count"], len(expected))
+            results = response.data["results"]
+            # Results should be nearest first and carry their distance in miles
+            self.assertEqual([store["id"] for store in results], [store_id for _, store_id in expected][:len(results)])
+            for store, (miles, _) in zip(results, expected):
+                self.assertAlmostEqual(store["distance"], miles, places=6)
+        # The bounding box should hold the whole circle, even far from the equator and across the antimeridian
+        for lat, lon, radius in [(30.27, -97.74, 50), (70.0, 20.0, 300), (0, 179.9, 100), (89.5, 0, 100)]:
+            min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius)
+            for bearing in range(0, 360, 5):
+                point_lat, point_lon = destination(lat, lon, radius * 0.999, bearing)
+                self.assertTrue(min_lat <= point_lat <= max_lat)
+                if min_lon is not None:
+                    self.assertTrue(min_lon <= point_lon <= max_lon)
+
+    def test_nearest_stores(self):
+        random.seed(11)
+        for i in range(300):
+            # Mostly one metro area plus a few stores scattered around the world
+            lat, lon = (random.uniform(30.0, 30.5), random.uniform(-98.0, -97.5)) if i % 10 else \
+                (random.uniform(-80, 80), random.uniform(-180, 180))
+            Store.objects.create(lat=lat, lon=lon, name="store %d" % i, hours=[])
+
+        def brute_force(lat, lon, k):
+            return [store.id for store in sorted(Store.objects.all(),
+                                                 key=lambda store: distance(lon, lat, store.lon, store.lat))[:k]]
+
+        for lat, lon, k in [(30.27, -97.74, 5), (30.27, -97.74, 40), (-45.0, 170.0, 3), (89.9, 0.0, 4),
+                            (0.0, 179.99, 6)]:
+            self.assertEqual(nearest_store_ids(lat, lon, k), brute_force(lat, lon, k))
+        self.assertEqual(len(nearest_store_ids(0, 0, 1000)), MAX_NEAREST_STORES)
+
+        response = self.client.get('/data/stores/?lat=30.27&lon=-97.74&k=8', **self.headers)
+        self.assertEqual([store["id"] for store in response.data["results"]], brute_force(30.27, -97.74, 8))
+        self.assertTrue(all(store["distance"] is not None for store in response.data["results"]))
+
+        # New stores should be found without waiting for the grid to expire
+        store = Store.objects.create(lat=30.2701, lon=-97.7401, name="new store", hours=[])
+        self.assertEqual(nearest_store_ids(30.27, -97.74, 1), [store.id])
+
+    def test_batch_distance(self):
+        random.seed(3)
+        points = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(500)] + [(30.27, -97.74)]
+        distances, within = batch_haversine(-97.74, 30.27, [lon for _, lon in points], [lat for lat, _ in points], 500)
+        for (lat, lon), miles, inside in zip(points, distances, within):
+            self.assertAlmostEqual(miles, distance(-97.74, 30.27, lon, lat), places=6)
+            self.assertEqual(inside, haversine(-97.74, 30.27, lon, lat, 500))
+
+    def test_conditional_get(self):
+        path = '/data/stores/' + unicode(self.store.id) + '/'
+        response = self.client.get(path, **self.headers)
+        etag = response['ETag']
+        self.assertIn("public", response['Cache-Control'])
+        self.assertIn("max-age", response['Cache-Control'])
+
+        # A matching ETag should be answered after the version lookup (the api key is cached), without loading the
+        # store
+        with self.assertNumQueries(1):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'], **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Saving a store should change the ETag of every store response
+        self.store.name = "renamed store"
+        self.store.save()
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["name"], "renamed store")
+        self.assertNotEqual(response['ETag'], etag)
+
 
 class DesignerTests(APITestCase):
     def setUp(self):
@@ -353,6 +849,268 @@ class DesignerTests(APITestCase):
         self.assertEqual(response.data["count"], 1)
         self.assertEqual(response.data["results"][0]["id"], item.id)
 
+    def test_designers_near(self):
+        near = [Store.objects.create(lat=30.27 + 0.01 * i, lon=-97.74, name="near %d" % i, hours=[]) for i in range(3)]
+        far = Store.objects.create(lat=40.71, lon=-74.0, name="far", hours=[])
+        other = Designer.objects.create(name="other designer", image="url")
+        distant = Designer.objects.create(name="distant designer", image="url")
+        for i, (store, designer) in enumerate([(near[0], self.designer), (near[0], self.designer),
+                                               (near[1], self.designer), (near[2], other), (far, other),
+                                               (far, distant)] * 5):
+            Item.objects.create(name="item %d" % i, sku="1", upc="2", price="30.00", images=[], store=store,
+                                designer=designer, category="c", designer_name=designer.name, thumbnail="url",
+                                sizes=[])
+
+        # One query each for the api key, the page count and the page, whatever the number of stores and items
+        with self.assertNumQueries(3):
+            response = self.client.get('/data/designers/?lat=30.27&lon=-97.74&radius=10', **self.headers)
+        self.assertEqual([(designer["id"], designer["nearby_store_count"]) for designer in response.data["results"]],
+                         [(other.id, 1), (self.designer.id, 2)])
+
+
+class TimingTests(APITestCase):
+    def test_capture_timings(self):
+        APIKey.objects.create(name="test_key", key="testing")
+        Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[])
+        with capture_timings() as timings:
+            self.client.get('/data/stores/', HTTP_API_KEY="testing")
+        # The api key lookup, the catalog versions, the page count and the page
+        self.assertEqual(timings.queries, 4)
+        # Sections should reach every capture, not only the per-request metrics nested inside this one
+        self.assertIn("serialize", timings.sections)
+        self.assertGreaterEqual(timings.wall_ms, timings.sql_ms)
+        self.assertEqual(timings.app_ms, timings.wall_ms - timings.sql_ms)
+        self.assertEqual([percentile(range(1, 101), p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([3.0], 95), 3.0)
+
+    def test_server_timing(self):
+        APIKey.objects.create(name="test_key", key="testing")
+        Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[])
+        with self.settings(SERVER_TIMING_SAMPLE_RATE=0.0):
+            response = self.client.get('/data/stores/', HTTP_API_KEY="testing")
+            self.assertFalse(response.has_header('Server-Timing'))
+            # The request header should time the request regardless of sampling
+            response = self.client.get('/data/stores/', HTTP_API_KEY="testing", HTTP_X_SERVER_TIMING="1")
+        metrics = dict(metric.split(";", 1) for metric in response['Server-Timing'].split(", "))
+        self.assertEqual(set(metrics), {"db", "view", "serialize", "render", "total"})
+        # The api key was cached by the first request
+        self.assertIn('desc="3 queries"', metrics["db"])
+
+    def test_metrics(self):
+        APIKey.objects.create(name="test_key", key="testing")
+        self.client.get('/data/stores/', HTTP_API_KEY="testing")
+        response = self.client.get('/data/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('brickandmortr_requests_total{method="GET",route="data.views.StoreList",status="200"}',
+                      response.content)
+        self.assertIn('brickandmortr_request_queries_bucket{le="3.0",method="GET",route="data.views.StoreList"}',
+                      response.content)
+        # Only INTERNAL_IPS may scrape the metrics
+        response = self.client.get('/data/metrics', REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_metrics_when_view_raises(self):
+        def view(request):
+            Store.objects.count()
+            raise ValueError("view failed")
+
+        labels = {"route": "unmatched", "method": "GET"}
+        errors = REGISTRY.get_sample_value('brickandmortr_request_errors_total', labels) or 0
+        queries = REGISTRY.get_sample_value('brickandmortr_request_queries_sum', labels) or 0
+        with self.assertRaises(ValueError):
+            MetricsMiddleware(view)(RequestFactory().get('/data/stores/'))
+        self.assertEqual(REGISTRY.get_sample_value('brickandmortr_request_errors_total', labels), errors + 1)
+        self.assertEqual(REGISTRY.get_sample_value('brickandmortr_request_queries_sum', labels), queries + 1)
+
+
+class ConnectionPoolTests(APITestCase):
+    def test_connection_pool(self):
+        params = connection.get_connection_params()
+        pool = ConnectionPool("test", max_size=1, timeout=0, health_check_interval=0)
+
+        def connect():
+            return psycopg2.connect(**params)
+
+        first = pool.checkout(connect)
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.checkout(connect)
+        # A connection left in a transaction should be rolled back and reused
+        first.cursor().execute("SELECT 1")
+        pool.release(first)
+        self.assertIs(pool.checkout(connect), first)
+        pool.release(first)
+        # A connection the server dropped should fail its health check and be replaced
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [first.get_backend_pid()])
+        second = pool.checkout(connect)
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.size, 1)
+        pool.release(second)
+        pool.close()
+        self.assertTrue(second.closed)
+
+
+class ReplicaTests(APITestCase):
+    def setUp(self):
+        APIKey.objects.create(name="test_key", key="testing")
+        self.user = BrickAndMortrUser.objects.create_user(username="test_saving@test.com", password="test")
+        self.store = Store.objects.create(lat=30.00, lon=90.00, name="test store", hours=[])
+        # A second connection to the test database can't see the test's uncommitted rows, like a lagging replica
+        connections.databases['replica'] = dict(connections.databases['default'])
+
+    def tearDown(self):
+        # Forget the users' pins
+        routers.pin_cache().clear()
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+
+    def test_replica_reads(self):
+        with self.settings(DATABASE_REPLICAS={'replica': 1}):
+            response = self.client.get('/data/stores/', HTTP_API_KEY="testing")
+            self.assertEqual(response.data["count"], 0)
+            designer = Designer.objects.create(name="test designer", image="url")
+            Item.objects.create(name="item", sku="666", upc="777", price="30.00", images=["url"], category="c",
+                                store=self.store, designer=designer, designer_name=designer.name, thumbnail="url",
+                                sizes=["small"])
+            # Facet counts should be read from the replica too
+            response = self.client.get('/data/items/facets', HTTP_API_KEY="testing")
+            self.assertEqual(response.data["categories"], [])
+            # A user's write should pin their following reads to the primary, without a cookie
+            self.client.force_authenticate(user=self.user)
+            response = self.client.post('/data/users/bag', ["item 1"], format='json')
+            self.assertEqual(response.cookies, {})
+            response = self.client.get('/data/stores/', HTTP_API_KEY="testing")
+            self.assertEqual(response.data["count"], 1)
+            self.assertNotIn('Set-Cookie', response)
+            # Other clients should still read from the replica
+            response = self.client_class().get('/data/stores/', HTTP_API_KEY="testing")
+            self.assertEqual(response.data["count"], 0)
+            # Queries on the replica should be timed like those on the primary
+            with capture_timings() as timings:
+                connections['replica'].cursor().execute("SELECT 1")
+            self.assertEqual(timings.queries, 1)
+        # Reads should fall back to the primary when no replica is reachable
+        self.client.force_authenticate(user=None)
+        with self.settings(DATABASE_REPLICAS={'missing': 1}):
+            response = self.client.get('/data/stores/', HTTP_API_KEY="testing")
+            self.assertEqual(response.data["count"], 1)
+
+    def test_internal_writes_do_not_pin(self):
+        request = RequestFactory().get('/data/stores/')
+        request.user = self.user
+        with self.settings(DATABASE_REPLICAS={'replica': 1}):
+            routers.start_request(request)
+            bump_versions(Store)
+            self.assertFalse(routers.pinned())
+            self.assertFalse(routers.end_request())
+            self.assertFalse(routers.user_pinned(self.user.pk))
+            routers.start_request(request)
+            self.user.save()
+            self.assertTrue(routers.pinned())
+            self.assertTrue(routers.end_request())
+            self.assertTrue(routers.user_pinned(self.user.pk))
+
+    def test_pins_are_shared(self):
+        # A pin stored through one worker's cache client should be seen through another's
+        routers.pin_user(self.user.pk)
+        other_worker = _create_cache(settings.DATABASE_REPLICA_PIN_CACHE)
+        self.assertIsNot(other_worker, routers.pin_cache())
+        self.assertIsNotNone(other_worker.get('primary_pin:%s' % self.user.pk))
+        # A cache local to each process can't hold pins
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                           DATABASE_REPLICA_PIN_CACHE='default'):
+            with self.assertRaises(ImproperlyConfigured):
+                routers.pin_user(self.user.pk)
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        expire_indexes()
+        self.key = APIKey.objects.create(name="test_key", key="testing")
+        self.headers = {
+            "HTTP_API_KEY": "testing"
+        }
+        self.store = Store.objects.create(lat=30.00, lon=90.00, name="Denim Outlet", address="123 test st",
+                                          contact_email="contact@test.com", contact_phone="1111111",
+                                          thumbnail="url.com",
+                                          hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        self.designer = Designer.objects.create(name="Acne Studios", image="url")
+        Designer.objects.create(name="Levi's", image="url")
+        for name in ("Raw Denim Jacket", "Denim Jeans", "Leather Boots"):
+            Item.objects.create(name=name, sku="666", upc="777", price="30.00", images=["url.com"], store=self.store,
+                                designer=self.designer, category="c", designer_name=self.designer.name,
+                                thumbnail="url.com", sizes=["small"])
+
+    def search(self):
+        designers = self.client.get('/data/designers/?name=acne studio', **self.headers)
+        stores = self.client.get('/data/stores/?name=denim', **self.headers)
+        items = self.client.get('/data/items/?query_params=' + json.dumps({"search": "denim jaket",
+                                                                           "sort": "relevance"}), **self.headers)
+        return ([designer["name"] for designer in designers.data["results"]],
+                [store["name"] for store in stores.data["results"]],
+                [item["name"] for item in items.data["results"]])
+
+    def test_python_search(self):
+        designers, stores, items = self.search()
+        self.assertEqual(designers, ["Acne Studios"])
+        self.assertEqual(stores, ["Denim Outlet"])
+        self.assertEqual(items, ["Denim Jeans", "Raw Denim Jacket"])
+
+    def test_index_search(self):
+        with self.settings(CATALOG_SEARCH_BACKEND="index"):
+            designers, stores, items = self.search()
+        self.assertEqual(designers, ["Acne Studios"])
+        self.assertEqual(stores, ["Denim Outlet"])
+        self.assertEqual(items, ["Denim Jeans", "Raw Denim Jacket"])
+
+    def test_index_matches_scan(self):
+        words = ["denim", "jacket", "raw", "leather", "boots", "tote", "clutch", "watch", "slim", "fit", "item", "12"]
+        names = [" ".join(words[(i * 7 + j * 5) % len(words)] for j in range(i % 4 + 1)) for i in range(60)]
+        for name in names:
+            Item.objects.create(name=name, sku="666", upc="777", price="30.00", images=["url.com"], store=self.store,
+                                designer=self.designer, category="c", designer_name=self.designer.name,
+                                thumbnail="url.com", sizes=["small"])
+        index = get_index(Item, 'name')
+        index.build()
+
+        # Shortlisting with the index should find exactly the items a full fuzzy_match scan finds
+        for query in ["denm", "jaket denm", "ab", "12", "item 4", "watch tote", "xyz", "!!"]:
+            scan = set(pk for pk, name in Item.objects.values_list('id', 'name') if fuzzy_match(name, query))
+            self.assertEqual(set(index.search(query)), scan)
+
+        # Saves and deletes should update the index in place
+        item = Item.objects.get(name="Leather Boots")
+        item.name = "Suede Loafers"
+        item.save()
+        self.assertIn(item.id, index.search("suede"))
+        self.assertNotIn(item.id, index.search("leather boots"))
+        item.delete()
+        self.assertNotIn(item.id, index.search("suede"))
+
+    def test_batch_fuzzy_match(self):
+        random.seed(5)
+        words = ["denim", "jacket", "jaket", "raw", "Leather", "boots", "boot", "tote", "clutch", "12", "a", "Café",
+                 "slim-fit", "!!", ""]
+        names = [" ".join(random.choice(words) for _ in range(random.randint(0, 4))) for _ in range(3000)] + [None]
+        # Batch scoring should agree with fuzzy_match exactly, in process and spread over a pool
+        for query in ["denm", "jaket denm", "boots", "12", "a", "cafe", "xyz", "!!", "", "leather raw slim fit"]:
+            expected = [fuzzy_match(name, query) for name in names]
+            self.assertEqual(fuzzy_match_many(names, query, processes=0), expected)
+            self.assertEqual(fuzzy_match_many(names, query, processes=2), expected)
+
+    def test_trigram_search(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest("pg_trgm is not installed")
+        with self.settings(CATALOG_SEARCH_BACKEND="trigram"):
+            designers, stores, items = self.search()
+        self.assertEqual(designers, ["Acne Studios"])
+        self.assertEqual(stores, ["Denim Outlet"])
+        # Trigram search should rank the closest match first
+        self.assertEqual(items[0], "Raw Denim Jacket")
+
 
 class CategoryTests(APITestCase):
     def setUp(self):
@@ -381,3 +1139,35 @@ class CategoryTests(APITestCase):
         self.assertEqual(len(response.data["results"][0]["sizes"] & set(item.sizes)), len(item.sizes))
         response = self.client.get('/data/subcategories/')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_subcategory_counts(self):
+        jackets = SubCategory.objects.create(display_name="Denim Jackets")
+        boots = SubCategory.objects.create(display_name="Boots")
+        store = Store.objects.create(lat=30.00, lon=90.00, name="test store", address="123 test st",
+                                     contact_email="contact@test.com", contact_phone="1111111", thumbnail="url.com",
+                                     hours=[[8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16], [8, 16]])
+        designer = Designer.objects.create(name="test designer", image="url.com")
+        items = [Item.objects.create(name="testing %d" % i, sku="666", upc="777", price="30.00", images=["url.com"],
+                                     store=store, designer=designer, category="c", subcategory=jackets,
+                                     designer_name=designer.name, thumbnail="url.com", sizes=sizes)
+                 for i, sizes in enumerate([["small", "medium"], ["medium"], []])]
+
+        def results():
+            # One query each for the catalog versions and the subcategories with their sizes, the api key being cached
+            with self.assertNumQueries(2):
+                response = self.client.get('/data/subcategories/', **self.headers)
+            return {(s["id"], s["item_count"], frozenset(s["sizes"])) for s in response.data["results"]}
+
+        self.client.get('/data/subcategories/', **self.headers)
+        self.assertEqual(results(), {(jackets.id, 3, frozenset(["small", "medium"]))})
+        # Moving, resizing and deleting items should keep the counts in step without a rebuild
+        items[0].subcategory = boots
+        items[0].save()
+        items[1].sizes = ["large"]
+        items[1].save()
+        items[2].delete()
+        self.assertEqual(results(), {(jackets.id, 1, frozenset(["large"])),
+                                     (boots.id, 1, frozenset(["small", "medium"]))})
+        rebuild_counts()
+        self.assertEqual(results(), {(jackets.id, 1, frozenset(["large"])),
+                                     (boots.id, 1, frozenset(["small", "medium"]))})
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Timings(object):
+    """
+    Query count, SQL time and wall clock time of a block of work, in milliseconds. Everything outside SQL is
+    counted as app time, which for API views is mostly serialization and rendering.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.wall_ms = 0.0
+        self.sections = OrderedDict()
+
+    def add(self, name, ms):
+        self.sections[name] = self.sections.get(name, 0.0) + ms
+
+    @property
+    def app_ms(self):
+        return max(self.wall_ms - self.sql_ms, 0.0)
+
+    def as_dict(self):
+        result = {"queries": self.queries, "sql_ms": self.sql_ms, "app_ms": self.app_ms, "wall_ms": self.wall_ms}
+        result.update((name + "_ms", ms) for name, ms in self.sections.items())
+        return result
+
+
+_local = threading.local()
+
+
+def _capturing():
+    """
+    The Timings being captured on this thread, outermost first
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def active_timings():
+    """
+    The innermost Timings being captured on this thread, if any
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def record_query(seconds):
+    """
+    Count a query that took seconds towards every Timings being captured on this thread. Called by the cursors of
+    data.backends.postgresql_pooled for every database alias.
+    """
+    for timings in getattr(_local, 'stack', ()):
+        timings.queries += 1
+        timings.sql_ms += seconds * 1000
+
+
+@contextmanager
+def section(name):
+    """
+    Add the time spent in the enclosed block to a named section of every Timings being captured on this thread, like
+    queries. Costs one attribute lookup when nothing is being captured.
+    """
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        yield
+        return
+    capturing = list(stack)
+    started = time.time()
+    try:
+        yield
+    finally:
+        ms = (time.time() - started) * 1000
+        for timings in capturing:
+            timings.add(name, ms)
+
+
+@contextmanager
+def capture_timings():
+    """
+    Time the enclosed block, with the queries it runs on any database alias counted as they run. Captures can
+    nest, e.g. a sampled Server-Timing request inside the metrics of every request.
+    """
+    timings = Timings()
+    stack = _capturing()
+    stack.append(timings)
+    started = time.time()
+    try:
+        yield timings
+    finally:
+        timings.wall_ms = (time.time() - started) * 1000
+        stack.remove(timings)
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of values
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
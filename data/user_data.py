@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db.models.expressions import RawSQL
+
+from data.models import BrickAndMortrUser
+
+# Each operation is one UPDATE of the field's column, evaluated against the row's current value so concurrent
+# operations from different devices all apply. Adding keeps the list free of duplicates, so retries are harmless,
+# comparing whole elements so an entry isn't mistaken for one that merely contains it.
+LIST_OPERATIONS = {
+    "add": ("CASE WHEN NOT EXISTS (SELECT 1 FROM jsonb_array_elements({column}) AS elements(element) "
+            "WHERE element = %s::jsonb) THEN {column} || %s::jsonb ELSE {column} END",
+            lambda value: [json.dumps(value), json.dumps([value])]),
+    "remove": ("COALESCE((SELECT jsonb_agg(element) FROM jsonb_array_elements({column}) AS elements(element) "
+               "WHERE element <> %s::jsonb), '[]'::jsonb)",
+               lambda value: [json.dumps(value)]),
+}
+OBJECT_OPERATIONS = {
+    "set": ("jsonb_set({column}, %s::text[], %s::jsonb)",
+            lambda key, value: [[key], json.dumps(value)]),
+    "remove": ("{column} - %s::text",
+               lambda key, value: [key]),
+}
+
+LIST_FIELDS = ('bag', 'favorites')
+OBJECT_FIELDS = ('preferences',)
+
+
+def entry_item_id(entry):
+    """
+    The item id a bag or favorites entry refers to, either the id itself or an object with an "id", or None
+    """
+    if isinstance(entry, dict):
+        entry = entry.get("id")
+    if isinstance(entry, bool):
+        return None
+    try:
+        return int(entry)
+    except (TypeError, ValueError):
+        return None
+
+
+def entry_quantity(entry):
+    try:
+        return max(int(entry.get("quantity", 1)), 0) if isinstance(entry, dict) else 1
+    except (TypeError, ValueError):
+        return 1
+
+
+def operation_sql(field, operation):
+    """
+    SQL and params applying a {"op": ..., "value": ...} operation (plus "key" for preferences) to a user field
+    """
+    if not isinstance(operation, dict) or "op" not in operation:
+        raise ValueError("Expected an object with an op.")
+    column = BrickAndMortrUser._meta.get_field(field).column
+    if field in LIST_FIELDS:
+        if operation["op"] not in LIST_OPERATIONS or "value" not in operation:
+            raise ValueError("Expected op add or remove with a value.")
+        sql, params = LIST_OPERATIONS[operation["op"]]
+        return sql.format(column='"%s"' % column), params(operation["value"])
+    if operation["op"] not in OBJECT_OPERATIONS or "key" not in operation or \
+            (operation["op"] == "set" and "value" not in operation):
+        raise ValueError("Expected op set with a key and value, or op remove with a key.")
+    sql, params = OBJECT_OPERATIONS[operation["op"]]
+    return sql.format(column='"%s"' % column), params(unicode(operation["key"]), operation.get("value"))
+
+
+def current(user, field):
+    """
+    The field as stored now. The request's user may come from the access token cache in data.auth, which other
+    requests' updates don't reach.
+    """
+    user.refresh_from_db(fields=[field])
+    return getattr(user, field)
+
+
+def apply_operation(user, field, operation):
+    """
+    Apply an operation to one of a user's JSON fields in a single UPDATE that touches only that column. The field
+    has to hold a list (bag, favorites) or an object (preferences), whatever a full replacement stored.
+    """
+    sql, params = operation_sql(field, operation)
+    column = BrickAndMortrUser._meta.get_field(field).column
+    json_type, description = ('array', "a list") if field in LIST_FIELDS else ('object', "an object")
+    # Checked in the same statement, the operations would fail on any other JSON type
+    rows = BrickAndMortrUser.objects.filter(id=user.id).extra(where=['jsonb_typeof("%s") = %%s' % column],
+                                                              params=[json_type])
+    if not rows.update(**{field: RawSQL(sql, params)}):
+        raise ValueError("The stored %s isn't %s, replace it first." % (field, description))
+    user.refresh_from_db(fields=[field])
+
+
+def replace(user, field, value):
+    BrickAndMortrUser.objects.filter(id=user.id).update(**{field: value})
+    setattr(user, field, value)
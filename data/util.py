@@ -1,10 +1,23 @@
-from fuzzywuzzy import fuzz
-from math import radians, cos, sin, asin, sqrt
+import itertools
+import multiprocessing
+from collections import Counter
 
+import numpy
+from django.conf import settings
+from fuzzywuzzy import fuzz, utils
+from math import radians, cos, sin, asin, sqrt, ceil
 
-def haversine(user_lon, user_lat, store_lon, store_lat, radius):
+FUZZY_MATCH_THRESHOLD = 50
+FUZZY_TOKEN_CACHE_SIZE = 100000
+FUZZY_POOL_MIN_BATCH = 2000
+
+
+EARTH_RADIUS_MILES = 3956  # Use 6371 for kilometers.
+
+
+def distance(user_lon, user_lat, store_lon, store_lat):
     """
-    Calculate the great circle distance between two points
+    Calculate the great circle distance in miles between two points
     on the earth (specified in decimal degrees)
     """
     user_lon = float(user_lon)
@@ -19,9 +32,138 @@ def haversine(user_lon, user_lat, store_lon, store_lat, radius):
     dlat = store_lat - user_lat
     a = sin(dlat/2)**2 + cos(user_lat) * cos(store_lat) * sin(dlon / 2) ** 2
     c = 2 * asin(sqrt(a))
-    r = 3956  # Radius of earth in miles. Use 6371 for kilometers.
-    return c * r <= float(radius)
+    return c * EARTH_RADIUS_MILES
+
+
+def haversine(user_lon, user_lat, store_lon, store_lat, radius):
+    """
+    Whether two points on the earth (specified in decimal degrees) are within radius miles of each other
+    """
+    return distance(user_lon, user_lat, store_lon, store_lat) <= float(radius)
+
+
+def batch_distance(user_lon, user_lat, store_lons, store_lats):
+    """
+    Great circle distances in miles from one point to arrays of points, computed in one vectorized pass
+    """
+    user_lon, user_lat = radians(float(user_lon)), radians(float(user_lat))
+    store_lons = numpy.radians(numpy.asarray(store_lons, dtype=numpy.float64))
+    store_lats = numpy.radians(numpy.asarray(store_lats, dtype=numpy.float64))
+
+    a = numpy.sin((store_lats - user_lat) / 2) ** 2 + cos(user_lat) * numpy.cos(store_lats) * \
+        numpy.sin((store_lons - user_lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def batch_haversine(user_lon, user_lat, store_lons, store_lats, radius):
+    """
+    Distances from one point to arrays of points, and a mask of the points within radius miles
+    """
+    distances = batch_distance(user_lon, user_lat, store_lons, store_lats)
+    return distances, distances <= float(radius)
 
 
 def fuzzy_match(string1, string2):
-    return fuzz.token_set_ratio(string1, string2) >= 50
+    return fuzz.token_set_ratio(string1, string2) >= FUZZY_MATCH_THRESHOLD
+
+
+_token_sets = {}
+# The fuzzy scoring pool and the number of processes it was started with
+_pool = None
+_pool_processes = 0
+
+
+def fuzzy_tokens(string):
+    """
+    The token set fuzz.token_set_ratio builds for string, with its sorted token string and that string's character
+    counts, cached across calls
+    """
+    if string is None:
+        return None
+    analyzed = _token_sets.get(string)
+    if analyzed is None:
+        if len(_token_sets) >= FUZZY_TOKEN_CACHE_SIZE:
+            _token_sets.clear()
+        tokens = frozenset(utils.full_process(string, force_ascii=True).split())
+        joined = " ".join(sorted(tokens))
+        analyzed = _token_sets[string] = (tokens, joined, Counter(joined))
+    return analyzed
+
+
+def _ratio_reaches(string1, string2, threshold, shared=None):
+    # fuzz.ratio(string1, string2) >= threshold, skipping the sequence match when the lengths, or the number of
+    # characters the strings share if known, already keep it under threshold
+    total = len(string1) + len(string2)
+    if shared is None:
+        shared = min(len(string1), len(string2))
+    if string1 != string2 and (not total or utils.intr(200.0 * shared / total) < threshold):
+        return False
+    return fuzz.ratio(string1, string2) >= threshold
+
+
+def token_set_match(analyzed1, analyzed2, threshold=FUZZY_MATCH_THRESHOLD):
+    """
+    fuzz.token_set_ratio >= threshold for two fuzzy_tokens results, stopping at the first comparison that reaches it
+    """
+    if not analyzed1 or not analyzed2 or not analyzed1[0] or not analyzed2[0]:
+        return False
+    (tokens1, joined1, counts1), (tokens2, joined2, counts2) = analyzed1, analyzed2
+    intersection = tokens1 & tokens2
+    if not intersection:
+        # Only the two full sorted token strings are compared, and their shared characters bound the ratio
+        shared = sum(min(count, counts1[char]) for char, count in counts2.items())
+        return _ratio_reaches(joined1, joined2, threshold, shared)
+    sorted_sect = " ".join(sorted(intersection))
+    combined_1to2 = (sorted_sect + " " + " ".join(sorted(tokens1 - intersection))).strip()
+    combined_2to1 = (sorted_sect + " " + " ".join(sorted(tokens2 - intersection))).strip()
+    return (_ratio_reaches(sorted_sect, combined_1to2, threshold) or
+            _ratio_reaches(sorted_sect, combined_2to1, threshold) or
+            _ratio_reaches(combined_1to2, combined_2to1, threshold))
+
+
+def _match_chunk(args):
+    strings, search_term = args
+    search_tokens = fuzzy_tokens(search_term)
+    return [token_set_match(fuzzy_tokens(string), search_tokens) for string in strings]
+
+
+def start_fuzzy_pool(processes=None):
+    """
+    Start the pool of CATALOG_FUZZY_PROCESSES (or processes) processes fuzzy_match_many uses by default.
+
+    Forked processes inherit open database connections, so this has to run before the process opens any, e.g. from
+    gunicorn's post_fork hook.
+    """
+    global _pool, _pool_processes
+    if processes is None:
+        processes = getattr(settings, 'CATALOG_FUZZY_PROCESSES', 0)
+    if _pool is not None:
+        _pool.terminate()
+    _pool = multiprocessing.Pool(processes) if processes > 1 else None
+    _pool_processes = processes if processes > 1 else 0
+    return _pool
+
+
+def _get_pool(processes):
+    if _pool is None or _pool_processes != processes:
+        start_fuzzy_pool(processes)
+    return _pool
+
+
+def fuzzy_match_many(strings, search_term, processes=None):
+    """
+    Whether each of strings fuzzy matches search_term, the same as calling fuzzy_match on each.
+
+    Token sets are cached per string, so repeated searches over the same names skip preprocessing. Batches of at
+    least FUZZY_POOL_MIN_BATCH strings are split over the pool started by start_fuzzy_pool, if any. Passing processes
+    starts a pool of that size on demand instead, which only callers without open connections (management commands,
+    tests) should do, so the web path passes processes=None and never forks.
+    """
+    strings = list(strings)
+    if processes is None:
+        processes = _pool_processes
+    if processes > 1 and len(strings) >= FUZZY_POOL_MIN_BATCH:
+        size = int(ceil(len(strings) / float(processes)))
+        chunks = [(strings[i:i + size], search_term) for i in range(0, len(strings), size)]
+        return list(itertools.chain.from_iterable(_get_pool(processes).map(_match_chunk, chunks)))
+    return _match_chunk((strings, search_term))
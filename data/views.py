@@ -4,9 +4,15 @@ from __future__ import unicode_literals
 import json
 import logging
 import random
+from decimal import Decimal
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Count
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from oauth2_provider.ext.rest_framework import OAuth2Authentication
 from rest_framework import status
@@ -17,13 +23,26 @@ from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from data.util import haversine, fuzzy_match
+from data import facets, home_feed, metrics, user_data
+from data.caching import catalog_condition
+from data.filters import filter_items, parse_query_params
+from data.geo import by_distance, nearest_store_ids, within_radius
+from data.pagination import CatalogPagination
+from data.search import search_q
 from models import Item, Store, BrickAndMortrUser, Designer, SubCategory
-from serializers import ItemSerializer, StoreSerializer, DesignerSerializer, SubCategorySerializer
+from serializers import ITEM_FIELDS, ITEM_RELATED, ItemReadSerializer, requested_item_fields, StoreSerializer, \
+    StoreDistanceSerializer, DesignerSerializer, NearbyDesignerSerializer, SubCategorySerializer
 
 logger = logging.getLogger(__name__)
 
 
+def query_flag(request, name):
+    """
+    Whether a boolean query parameter like ?hydrate=true is switched on, with 1 or true
+    """
+    return request.query_params.get(name, '').lower() in ('1', 'true')
+
+
 class DesignersResultsSetPagination(PageNumberPagination):
     page_size = 20
 
@@ -49,159 +68,242 @@ def create_user(request):
     return Response({"message": "Username already in use."}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def patch_user_data(request, field):
+    """
+    Apply one operation to a user's bag, favorites or preferences instead of replacing the whole document:
+    {"op": "add" or "remove", "value": ...} for the bag and favorites, {"op": "set", "key": ..., "value": ...} or
+    {"op": "remove", "key": ...} for preferences
+    """
+    try:
+        user_data.apply_operation(request.user, field, request.data)
+    except ValueError as error:
+        return Response({"message": unicode(error)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({"message": "Updated user %s." % field}, status=status.HTTP_200_OK)
+
+
+def hydrated_user_items(request, field):
+    """
+    The items of a user's bag or favorites with their store and designer, fetched in one query, in list order and
+    without entries whose item no longer exists. The bag also gets the subtotal of the current prices.
+    """
+    entries = user_data.current(request.user, field)
+    ids = [user_data.entry_item_id(entry) for entry in entries]
+    items = Item.objects.select_related(*ITEM_RELATED).in_bulk([item_id for item_id in ids if item_id is not None])
+    found = [(entry, items[item_id]) for entry, item_id in zip(entries, ids) if item_id in items]
+    serializer = ItemReadSerializer([item for _, item in found], many=True)
+    data = {"results": serializer.data}
+    if field == 'bag':
+        subtotal = sum((item.price * user_data.entry_quantity(entry) for entry, item in found), Decimal('0.00'))
+        data["subtotal"] = ItemReadSerializer.price_field.to_representation(subtotal)
+    return Response(data, status=status.HTTP_200_OK)
+
+
 @csrf_exempt
-@api_view(['GET', 'POST'])
+@api_view(['GET', 'POST', 'PATCH'])
 @authentication_classes((OAuth2Authentication,))
 @permission_classes((IsAuthenticated,))
 def update_favorites(request):
-    if request.method == "GET":
-        return Response(json.loads(request.user.favorites_json), status=status.HTTP_200_OK)
+    if request.method == "GET" and query_flag(request, "hydrate"):
+        return hydrated_user_items(request, 'favorites')
+    elif request.method == "GET":
+        return Response(user_data.current(request.user, 'favorites'), status=status.HTTP_200_OK)
+    elif request.method == "PATCH":
+        return patch_user_data(request, 'favorites')
     else:
-        request.user.favorites_json = json.dumps(request.data)
-        request.user.save()
+        user_data.replace(request.user, 'favorites', request.data)
         return Response({"message": "Updated user favorites."}, status=status.HTTP_200_OK)
 
 
 @csrf_exempt
-@api_view(['GET', 'POST'])
+@api_view(['GET', 'POST', 'PATCH'])
 @authentication_classes((OAuth2Authentication,))
 @permission_classes((IsAuthenticated,))
 def update_bag(request):
-    if request.method == "GET":
-        return Response(json.loads(request.user.bag_json), status=status.HTTP_200_OK)
+    if request.method == "GET" and query_flag(request, "hydrate"):
+        return hydrated_user_items(request, 'bag')
+    elif request.method == "GET":
+        return Response(user_data.current(request.user, 'bag'), status=status.HTTP_200_OK)
+    elif request.method == "PATCH":
+        return patch_user_data(request, 'bag')
     else:
-        request.user.bag_json = json.dumps(request.data)
-        request.user.save()
+        user_data.replace(request.user, 'bag', request.data)
         return Response({"message": "Updated user bag."}, status=status.HTTP_200_OK)
 
 
 @csrf_exempt
-@api_view(['GET', 'POST'])
+@api_view(['GET', 'POST', 'PATCH'])
 @authentication_classes((OAuth2Authentication,))
 @permission_classes((IsAuthenticated,))
 def update_preferences(request):
     if request.method == "GET":
-        return Response(json.loads(request.user.preferences_json), status=status.HTTP_200_OK)
+        return Response(user_data.current(request.user, 'preferences'), status=status.HTTP_200_OK)
+    elif request.method == "PATCH":
+        return patch_user_data(request, 'preferences')
     else:
-        request.user.preferences_json = json.dumps(request.data)
-        request.user.save()
+        user_data.replace(request.user, 'preferences', request.data)
         return Response({"message": "Updated user preferences."}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
+@catalog_condition(SubCategory, Item)
 def subcategory_list(request):
     if request.method == "GET":
-        subcategory_ids = [item.subcategory_id for item in Item.objects.all()]
-        subcategories = SubCategorySerializer(list(SubCategory.objects.filter(id__in=subcategory_ids)), many=True)
-        for subcategory in subcategories.data:
-            sizes = set()
-            for item in Item.objects.all():
-                if item.subcategory_id == subcategory["id"]:
-                    sizes.update(set(item.sizes))
-            subcategory["sizes"] = sizes
-        return Response({"results": subcategories.data}, status=status.HTTP_200_OK)
+        queryset = SubCategory.objects.filter(item_count__gt=0).annotate(size_list=ArrayAgg('sizes__size'))
+        subcategories = list(queryset.order_by('id'))
+        serializer = SubCategorySerializer(subcategories, many=True)
+        for subcategory, data in zip(subcategories, serializer.data):
+            data["item_count"] = subcategory.item_count
+            data["sizes"] = set(size for size in subcategory.size_list if size is not None)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
 
 
-class FeaturedItems(ListAPIView):
-    serializer_class = ItemSerializer
+@api_view(['GET'])
+@catalog_condition(*home_feed.FEED_MODELS)
+def home(request):
+    """
+    Featured, new, sale and per-category items for the home screen, served pre-serialized from the snapshot
+    refresh_home_feed keeps up to date
+    """
+    served = home_feed.current_snapshot(request.catalog_etag)
+    if served is None:
+        response = Response({"message": "The home feed hasn't been built yet."},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = 60
+        return response
+    etag, payload = served
+    if etag == request.catalog_etag:
+        return HttpResponse(payload, content_type='application/json')
+    # Until refresh_home_feed catches up with the catalog, the older snapshot is served under its own ETag so
+    # clients and caches revalidate it
+    response = get_conditional_response(request, etag=etag) or HttpResponse(payload, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['GET'])
+def item_facets(request):
+    params = parse_query_params(request.GET.get("query_params", ""))
+    return Response(facets.item_facets(params), status=status.HTTP_200_OK)
+
+
+class ItemResponseMixin(object):
+    """
+    Item views honouring ?fields= to return only some item fields, skipping the joins for relations left out, and
+    for lists ?included=true to give relations as ids with each related object once in the response's "included"
+    """
+    serializer_class = ItemReadSerializer
+
+    def get_serializer_context(self):
+        context = super(ItemResponseMixin, self).get_serializer_context()
+        context['fields'] = requested_item_fields(self.request)
+        context['included'] = isinstance(self, ListAPIView) and query_flag(self.request, 'included')
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        self.item_serializer = super(ItemResponseMixin, self).get_serializer(*args, **kwargs)
+        return self.item_serializer
+
+    def filter_queryset(self, queryset):
+        queryset = super(ItemResponseMixin, self).filter_queryset(queryset)
+        fields = requested_item_fields(self.request)
+        if fields is ITEM_FIELDS:
+            return queryset
+        # Pagination reads the ordering values of the last item
+        ordering = [name.lstrip('-') for name in queryset.query.order_by if name.lstrip('-') in ITEM_FIELDS]
+        queryset = queryset.select_related(None).only('id', *(set(fields) | set(ordering)))
+        related = [name for name in ITEM_RELATED if name in fields]
+        # select_related() without names would follow every relation
+        return queryset.select_related(*related) if related else queryset
+
+    def get_paginated_response(self, data):
+        response = super(ItemResponseMixin, self).get_paginated_response(data)
+        included = getattr(self.item_serializer, 'child', self.item_serializer).included
+        if included is not None:
+            response.data['included'] = included
+        return response
+
+
+class FeaturedItems(ItemResponseMixin, ListAPIView):
 
     def get_queryset(self):
-        featured_items = Item.objects.filter(featured=True)
-        e = Item.objects.extra(select={'price_float': 'CAST(price AS FLOAT)'}, order_by=['-price_float', 'name'])[:10]
+        featured_items = Item.objects.filter(featured=True).select_related(*ITEM_RELATED)
+        e = Item.objects.select_related(*ITEM_RELATED).order_by('-price', 'name')[:10]
         return featured_items if featured_items.count() > 0 else e
 
 
-class ItemList(ListAPIView):
-    serializer_class = ItemSerializer
+class ItemList(ItemResponseMixin, ListAPIView):
+    pagination_class = CatalogPagination
 
     def get_queryset(self):
-        items = Item.objects.order_by('name').all()
-        param_string = self.request.GET.get("query_params", "")
-        if param_string:
-            params = json.loads(param_string)
-            categories = params.get("categories", [])
-            designers = params.get("designers", [])
-            stores = params.get("stores", [])
-            subcategories = params.get("subcategories", [])
-            search_term = params.get("search", "")
-            price_info = params.get("price", {})
-            sort = params.get("sort", "")
-
-            if sort == "new_items":
-                items = Item.objects.order_by('-added_on', 'name').all()
-            elif sort == "sale":
-                items = Item.objects.order_by('-sale', 'name').all()
-            elif sort == "price_low":
-                items = Item.objects.extra(select={'price_float': 'CAST(price AS FLOAT)'},
-                                           order_by=['price_float', 'name'])
-            elif sort == "price_high":
-                items = Item.objects.extra(select={'price_float': 'CAST(price AS FLOAT)'},
-                                           order_by=['-price_float', 'name'])
-
-            if search_term:
-                item_ids = [item.id for item in items if fuzzy_match(item.name, search_term)]
-                items = items.filter(id__in=item_ids)
-            if categories:
-                items = items.filter(category__in=categories)
-            if designers:
-                items = items.filter(designer__in=designers)
-            if stores:
-                items = items.filter(store__in=stores)
-            if subcategories:
-                item_ids = list()
-                for item in items:
-                    for subcategory in subcategories:
-                        sizes = subcategory.get("sizes", item.sizes)
-                        intersection = set(item.sizes).intersection(sizes)
-                        if item.subcategory and item.subcategory_id == subcategory["id"] and intersection:
-                            item_ids.append(item.id)
-                items = items.filter(id__in=item_ids)
-            if "max" in price_info:
-                prices = [item.price for item in items if float(item.price) <= float(price_info["max"])]
-                items = items.filter(price__in=prices)
-            if "min" in price_info:
-                prices = [item.price for item in items if float(item.price) >= float(price_info["min"])]
-                items = items.filter(price__in=prices)
-        return items
-
-
-class ItemDetail(RetrieveAPIView):
-    queryset = Item.objects.all()
-    serializer_class = ItemSerializer
+        params = parse_query_params(self.request.GET.get("query_params", ""))
+        return filter_items(params).select_related(*ITEM_RELATED)
+
 
+@method_decorator(catalog_condition(Item, Store, Designer, SubCategory), name='get')
+class ItemDetail(ItemResponseMixin, RetrieveAPIView):
+    queryset = Item.objects.select_related(*ITEM_RELATED)
 
+
+@method_decorator(catalog_condition(Store), name='get')
 class StoreList(ListAPIView):
     serializer_class = StoreSerializer
 
+    def is_radius_search(self):
+        return all(self.request.GET.get(param, "") for param in ("lat", "lon", "radius"))
+
+    def is_nearest_search(self):
+        return all(self.request.GET.get(param, "") for param in ("lat", "lon", "k"))
+
+    def get_serializer_class(self):
+        # Radius and nearest store searches are sorted nearest first and include each store's distance in miles
+        if self.is_radius_search() or self.is_nearest_search():
+            return StoreDistanceSerializer
+        return StoreSerializer
+
     def get_queryset(self):
+        name = self.request.GET.get("name", "")
         lat = self.request.GET.get("lat", "")
         lon = self.request.GET.get("lon", "")
         radius = self.request.GET.get("radius", "")
+        k = self.request.GET.get("k", "")
 
         stores = Store.objects.order_by('name').all()
-        if lat and lon and radius:
-            store_ids = [store.id for store in Store.objects.all() if haversine(lon, lat, store.lon, store.lat, radius)]
-            stores = stores.filter(id__in=store_ids)
+        if self.is_nearest_search():
+            stores = stores.filter(id__in=nearest_store_ids(lat, lon, k))
+        if self.is_radius_search():
+            stores = within_radius(stores, lat, lon, radius)
+        elif self.is_nearest_search():
+            stores = by_distance(stores, lat, lon)
+        if name:
+            stores = stores.filter(search_q(Store, 'name', name))
         return stores
 
 
+@method_decorator(catalog_condition(Store), name='get')
 class StoreDetail(RetrieveAPIView):
     queryset = Store.objects.all()
     serializer_class = StoreSerializer
 
 
-class StoreItems(ListAPIView):
-    serializer_class = ItemSerializer
+class StoreItems(ItemResponseMixin, ListAPIView):
+    pagination_class = CatalogPagination
 
     def get_queryset(self):
         store_id = self.kwargs['store_id']
-        return Store.objects.get(id=store_id).item_set.order_by('name').all()
+        return Store.objects.get(id=store_id).item_set.select_related(*ITEM_RELATED).order_by('name').all()
 
 
 class DesignerList(ListAPIView):
     serializer_class = DesignerSerializer
     pagination_class = DesignersResultsSetPagination
 
+    def is_radius_search(self):
+        return all(self.request.GET.get(param, "") for param in ("lat", "lon", "radius"))
+
+    def get_serializer_class(self):
+        # Radius searches include how many nearby stores carry each designer
+        return NearbyDesignerSerializer if self.is_radius_search() else DesignerSerializer
+
     def get_queryset(self):
         name = self.request.GET.get("name", "")
         lat = self.request.GET.get("lat", "")
@@ -209,31 +311,30 @@ class DesignerList(ListAPIView):
         radius = self.request.GET.get("radius", "")
         category = self.request.GET.get("category", "")
         designers = Designer.objects.order_by('name').all()
-        if lat and lon and radius:
-            store_ids = [store.id for store in Store.objects.all() if haversine(lon, lat, store.lon, store.lat, radius)]
-            designer_ids = list()
-            for store in Store.objects.filter(id__in=store_ids):
-                designer_ids.extend([item.designer.id for item in store.item_set.all()])
-            designers = designers.filter(id__in=designer_ids)
+        if self.is_radius_search():
+            nearby_stores = within_radius(Store.objects.all(), lat, lon, radius).order_by().values('id')
+            # Filtering before annotating makes the count use the same join, so only nearby stores are counted
+            designers = designers.filter(item__store__in=nearby_stores).annotate(
+                nearby_store_count=Count('item__store', distinct=True))
         if name:
-            fuzzy_match_ids = [designer.id for designer in designers if fuzzy_match(name, designer.name)]
-            designers = designers.filter(id__in=fuzzy_match_ids)
+            designers = designers.filter(search_q(Designer, 'name', name))
         if category:
             designers = designers.filter(category=category)
         return designers
 
 
+@method_decorator(catalog_condition(Designer), name='get')
 class DesignerDetail(RetrieveAPIView):
     queryset = Designer.objects.all()
     serializer_class = DesignerSerializer
 
 
-class DesignerItems(ListAPIView):
-    serializer_class = ItemSerializer
+class DesignerItems(ItemResponseMixin, ListAPIView):
+    pagination_class = CatalogPagination
 
     def get_queryset(self):
         designer_id = self.kwargs['designer_id']
-        return Designer.objects.get(id=designer_id).item_set.order_by('name').all()
+        return Designer.objects.get(id=designer_id).item_set.select_related(*ITEM_RELATED).order_by('name').all()
 
 
 def generate_clothing_subcategories():
@@ -355,5 +456,12 @@ def generate_designers(request):
     return HttpResponse(json.dumps({"message": "Added designers to db!"}))
 
 
+def metrics_exposition(request):
+    # Only for the Prometheus scraper, the metrics name every route and how it performs
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        raise Http404
+    return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
 def page_not_found(request):
     return render(request, '404.html', None)
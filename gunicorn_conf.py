@@ -1,5 +1,31 @@
+import os
+import shutil
+
 bind = "0.0.0.0:8000"
 
+# Workers write their Prometheus samples to files here so /data/metrics can report all of them together. The
+# variable has to be set before the workers import prometheus_client, which is why it is set in the config.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/brickandmortr_metrics')
+
+
+def on_starting(server):
+    # Samples left by a previous master would be added to this one's
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):
+    # Fork the fuzzy scoring processes before the worker opens any database connections they would inherit
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brickandmortr_server.settings')
+    from data.util import start_fuzzy_pool
+    start_fuzzy_pool()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
 # errorlog = '-'
 # loglevel = 'info'
 # accesslog = '-'